@@ -0,0 +1,297 @@
+#! /usr/bin/env python3
+#
+# Benchmarks of the report pipeline and of the CSV importer.
+#
+# Usage:
+#   ./bench.py [-o bench.json] [--repeat 3] [--scales 1 10 100]
+#   ./bench.py --compare old.json new.json [--threshold 0.2] [--min-diff 0.02]
+#
+# Every stage is timed separately and the best of --repeat runs is kept.
+# Importer stages run on synthetic CSV files, --scales times the size of the
+# mod inspector data. --compare exits with status 1 if a stage got slower
+# by more than --threshold (0.2 is 20%) and by at least --min-diff seconds.
+# Stages of each nation are also compared summed, as 'render/*' and so on.
+#
+import io
+import os
+import csv
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import tempfile
+import importlib.util
+
+import core
+import gamedata_bin
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+IMPORTER = os.path.join(HERE, 'csv_to_import', 'import_from_modinspector.py')
+
+# Rows of each mod inspector file at scale 1, roughly those of Dominions 3
+BASE_ROWS = {'MagicSites.csv': 900, 'BaseU.csv': 2100, 'Nations.csv': 80,
+             'Spells.csv': 1100, 'BaseI.csv': 400}
+MASKS = [128 << n for n in range(len(core.MAGIC_PATHS))] # See unmasked()
+
+
+def best_time(func, repeat):
+    """Best wall time of func() in seconds, and its last result"""
+    best = None
+    for n in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def fresh_mages(mages):
+    """Mage objects built without help of the variant cache"""
+    core.variant_cache.entries = dict()
+    return [core.Mage(md['paths'], md['name'], md['gcost']) for md in mages]
+
+def synthetic_paths(count, seed=0):
+    """Path strings of mages with many random picks, like
+    'FWWEEE,100FWE,10FWE,50FAWESDNB*2'"""
+    rnd = random.Random(seed)
+    result = []
+    for n in range(count):
+        base = ''.join(path * rnd.randint(0, 2)
+                       for path in rnd.sample(core.MAGIC_PATHS, 3))
+        tokens = [base] if base else []
+        for pick in range(rnd.randint(3, 5)):
+            letters = ''.join(rnd.sample(core.MAGIC_PATHS, rnd.randint(1, 6)))
+            letters = ''.join(sorted(letters, key=core.MAGIC_PATHS.index))
+            token = str(rnd.choice((10, 25, 50, 100))) + letters
+            if rnd.random() < 0.1:
+                token += '*2'
+            tokens.append(token)
+        result.append(','.join(tokens))
+    return result
+
+
+def write_table(filename, header, rows):
+    with open(filename, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile, delimiter='\t', lineterminator='\n')
+        writer.writerow(header)
+        writer.writerows(rows)
+
+def write_synthetic_csvs(directory, scale, seed=0):
+    """Writes the five mod inspector files with made up contents and
+    BASE_ROWS * scale rows each. Unused columns are included, as in the
+    real files."""
+    rnd = random.Random(seed)
+    rows = {name: count * scale for name, count in BASE_ROWS.items()}
+    units = rows['BaseU.csv']
+
+    def maybe(low, high, empty):
+        return '' if rnd.random() < empty else str(rnd.randint(low, high))
+
+    paths = core.MAGIC_PATHS
+    coms = ['com{0}'.format(n) for n in range(1, 5)]
+    hcoms = ['hcom{0}'.format(n) for n in range(1, 5)]
+    write_table(os.path.join(directory, 'MagicSites.csv'),
+        ['id', 'name', 'rarity'] + list(paths[:-1]) + coms + hcoms,
+        [[str(n), 'Site {0}'.format(n), maybe(0, 5, 0)] +
+         [maybe(1, 3, 0.8) for p in paths[:-1]] +
+         [maybe(1, units, 0.7) for c in coms + hcoms]
+         for n in range(1, rows['MagicSites.csv'] + 1)])
+
+    header = ['id', 'name', 'uniquename', 'gcost', 'hp', 'str', 'att', 'def']
+    header += list(paths)
+    for n in '1234':
+        header += ['rand' + n, 'nbr' + n, 'link' + n, 'mask' + n]
+    table = []
+    for n in range(1, units + 1):
+        row = [str(n), 'Unit {0}'.format(n),
+               rnd.choice(('', '', '', 'Unique {0}'.format(n))),
+               str(rnd.randint(0, 400))] + [maybe(5, 30, 0) for s in range(4)]
+        row += [maybe(1, 3, 0.85) for p in paths]
+        for pick in range(4):
+            if rnd.random() < 0.25:
+                row += [str(rnd.choice((10, 25, 50, 100))),
+                        str(rnd.randint(1, 3)), str(rnd.choice((0, 1, 2))),
+                        str(sum(rnd.sample(MASKS, rnd.randint(1, 5))))]
+            else:
+                row += ['', '', '', '']
+        table.append(row)
+    write_table(os.path.join(directory, 'BaseU.csv'), header, table)
+
+    fields = (['com{0}'.format(n) for n in range(1, 13)] +
+              ['hero{0}'.format(n) for n in range(1, 7)] +
+              ['uwc{0}'.format(n) for n in range(1, 6)])
+    sites = ['site{0}'.format(n) for n in range(1, 5)]
+    write_table(os.path.join(directory, 'Nations.csv'),
+        ['id', 'name', 'epithet', 'era'] + fields + sites,
+        [[str(n), 'Nation {0}'.format(n), 'Epithet {0}'.format(n),
+          str(rnd.randint(1, 3))] + [maybe(1, units, 0.5) for f in fields] +
+         [maybe(1, rows['MagicSites.csv'], 0.6) for s in sites]
+         for n in range(1, rows['Nations.csv'] + 1)])
+
+    restricted = ['restricted{0}'.format(n) for n in range(1, 8)]
+    table = []
+    for n in range(1, rows['Spells.csv'] + 1):
+        effect = rnd.choice((1, 2, 600, 10001, 10021, 10089, 10100, 10076))
+        damage = rnd.randint(1, 2) if effect == 10100 else rnd.randint(1, units)
+        table.append([str(n), 'Spell {0}'.format(n),
+            str(rnd.choice((0, 1, 2, 3, 4, 5, 6, 7, 255))),
+            str(rnd.randint(0, 9)), str(rnd.randint(0, 8)),
+            str(rnd.randint(1, 5)), str(rnd.choice((255, 255, 0, 4, 6))),
+            str(rnd.randint(1, 3))] +
+            [maybe(1, rows['Nations.csv'], 0.9) for r in restricted] +
+            [str(effect), str(damage), str(rnd.choice((5, 50, 100, 2500)))])
+    write_table(os.path.join(directory, 'Spells.csv'),
+        ['id', 'name', 'school', 'researchlevel', 'path1', 'pathlevel1',
+         'path2', 'pathlevel2'] + restricted +
+        ['effect', 'damage', 'fatiguecost'], table)
+
+    table = []
+    for n in range(1, rows['BaseI.csv'] + 1):
+        second = rnd.random() < 0.4
+        table.append([str(n), 'Item {0}'.format(n),
+            str(rnd.choice((0, 2, 4, 6, 8, 12))), rnd.choice(paths),
+            str(rnd.randint(1, 3)), rnd.choice(paths) if second else '',
+            str(rnd.randint(1, 2)) if second else ''] +
+            [maybe(1, 2, 0.9) for p in paths])
+    write_table(os.path.join(directory, 'BaseI.csv'),
+        ['id', 'name', 'constlevel', 'mainpath', 'mainlevel',
+         'secondarypath', 'secondarylevel'] + list(paths), table)
+
+
+def load_importer():
+    spec = importlib.util.spec_from_file_location('import_from_modinspector',
+                                                  IMPORTER)
+    importer = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = importer # So that its readers can be pickled
+    spec.loader.exec_module(importer)
+    return importer
+
+def bench_report(timings, repeat, datafile='gamedata.json'):
+    timings['load_json'], data = best_time(
+        lambda: core.load_gamedata(datafile), repeat)
+    with tempfile.TemporaryDirectory() as tmp:
+        packed = os.path.join(tmp, 'gamedata.bin')
+        gamedata_bin.dump(data, packed)
+        timings['load_bin'], unused = best_time(
+            lambda: core.load_gamedata(packed), repeat)
+
+    mages = list(data['mages'].values())
+    timings['generate_variants'], unused = best_time(
+        lambda: fresh_mages(mages), repeat)
+    synthetic = [{'paths': paths, 'name': 'Synthetic', 'gcost': 0}
+                 for paths in synthetic_paths(100)]
+    timings['generate_variants_synthetic'], unused = best_time(
+        lambda: fresh_mages(synthetic), repeat)
+
+    for ndata in data['nations']:
+        name = '{0}: {1}'.format(ndata['name'], ndata['epithet'])
+        spells = data['spells'] + ndata['nspells'] + data['items']
+        # A new Nation each time, so its castability matrix isn't reused
+        timings['spells_by_mage/' + name], by_mage = best_time(
+            lambda: core.Nation(ndata, data['mages']).spells_by_mage(spells),
+            repeat)
+        nation = core.Nation(ndata, data['mages'])
+        timings['render/' + name], unused = best_time(
+            lambda: nation.print_by_mage(by_mage, io.StringIO()), repeat)
+
+def bench_importer(timings, repeat, scales):
+    importer = load_importer()
+    cwd = os.getcwd()
+    for scale in scales:
+        with tempfile.TemporaryDirectory() as tmp:
+            write_synthetic_csvs(tmp, scale)
+            os.chdir(tmp)
+            try:
+                prefix = 'import_x{0}/'.format(scale)
+                timings[prefix + 'read_sites'], sites = best_time(
+                    lambda: importer.read_sites('MagicSites.csv'), repeat)
+                timings[prefix + 'read_mages'], mages = best_time(
+                    lambda: importer.read_mages('BaseU.csv'), repeat)
+                timings[prefix + 'read_nations'], unused = best_time(
+                    lambda: importer.read_nations('Nations.csv', mages,
+                                                  sites), repeat)
+                timings[prefix + 'read_spells'], unused = best_time(
+                    lambda: importer.read_spells('Spells.csv', mages), repeat)
+                timings[prefix + 'read_items'], unused = best_time(
+                    lambda: importer.read_items('BaseI.csv'), repeat)
+                for jobs in (1, len(importer.TABLES)):
+                    timings[prefix + 'build_output_j{0}'.format(jobs)], \
+                        unused = best_time(lambda: importer.build_output(
+                            importer.ImportCache(None, load=False),
+                            jobs=jobs), repeat)
+            finally:
+                os.chdir(cwd)
+
+def with_totals(timings):
+    """timings plus the sum of each group of stages, like 'render/*' for
+    'render/Ulm: Enigma of Steel' and the other nations"""
+    result = dict(timings)
+    for stage, seconds in timings.items():
+        group, sep, rest = stage.rpartition('/')
+        if sep:
+            result[group + '/*'] = result.get(group + '/*', 0) + seconds
+    return result
+
+def compare(old_file, new_file, threshold, min_diff=0.02):
+    """Prints stages of both runs side by side; True if none regressed.
+    A stage regressed if it got slower by more than threshold (a ratio) and
+    by at least min_diff seconds, so that stages of a few milliseconds
+    don't fail on noise; their group totals still can."""
+    with open(old_file) as old, open(new_file) as new:
+        old = with_totals(json.load(old)['timings'])
+        new = with_totals(json.load(new)['timings'])
+    regressions = []
+    width = max(len(stage) for stage in new)
+    for stage in sorted(set(old) & set(new)):
+        ratio = new[stage] / old[stage] if old[stage] else 1.0
+        flag = ''
+        if ratio > 1 + threshold and new[stage] - old[stage] >= min_diff:
+            flag = '  REGRESSION'
+            regressions.append(stage)
+        print('{0}  {1:10.6f}  {2:10.6f}  {3:6.2f}x{4}'.format(
+            stage.ljust(width), old[stage], new[stage], ratio, flag))
+    for stage in sorted(set(old) ^ set(new)):
+        print('{0}  only in {1}'.format(
+            stage.ljust(width), old_file if stage in old else new_file))
+    print('{0} regression(s) over {1:.0%} and {2}s'.format(len(regressions),
+                                                           threshold,
+                                                           min_diff))
+    return not regressions
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Times the stages of the report and of the importer.')
+    parser.add_argument('-o', '--output', default='bench.json',
+                        help='file to write the results to')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of each stage, the best one counts')
+    parser.add_argument('--scales', type=int, nargs='*', default=[10, 100],
+                        help='sizes of synthetic CSV files, relative to the '
+                        'mod inspector data')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two result files instead')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='slowdown counted as a regression by --compare')
+    parser.add_argument('--min-diff', type=float, default=0.02,
+                        help='seconds a stage must lose, besides --threshold, '
+                        'to count as a regression')
+    args = parser.parse_args()
+    if args.compare:
+        sys.exit(0 if compare(args.compare[0], args.compare[1],
+                              args.threshold, args.min_diff) else 1)
+
+    os.chdir(HERE)
+    timings = dict()
+    bench_report(timings, args.repeat)
+    bench_importer(timings, args.repeat, args.scales)
+    results = {'meta': {'python': platform.python_version(),
+                        'machine': platform.machine(),
+                        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                        'repeat': args.repeat, 'scales': args.scales},
+               'timings': timings}
+    with open(args.output, 'w') as outfile:
+        json.dump(results, outfile, sort_keys=True, indent=4)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,404 @@
+#! /usr/bin/env python3
+#
+# Randomized differential checks of the optimized engines against the plain
+# implementations they replaced, kept here as references:
+# - Mage variants (generate_variants, reduce_variants, annotate_variants and
+#   the variant cache): a cartesian product of all tokens, Fraction chances
+# - can_cast, CastabilityMatrix rows and boosted rows, chance_to_cast and
+#   possible_spells: spell paths looked up in the variant's paths string
+# - Nation.first_in_second and first_in_second2
+#
+# Mage path strings and spells are made up, following the grammar of the
+# game data, like 'FWWEEE,100FWE,10FWE*2'. Chances must be equal as
+# Fractions and castable spells identical; mismatches are printed and the
+# exit status is 1.
+#
+# Usage:
+#   ./check.py [--mages 200] [--spells 200] [--seed 0]
+#   ./check.py --mages 1000 --min-speedup 1 -o check.json
+#
+# Both engines are also timed. --min-speedup fails the run if an optimized
+# engine isn't that many times faster than its reference, and the timings
+# written by -o can be compared across runs with bench.py --compare.
+#
+import sys
+import json
+import time
+import random
+import string
+import argparse
+import platform
+from itertools import groupby
+from fractions import Fraction as Frac
+from operator import itemgetter
+
+import core
+from bench import best_time, fresh_mages
+from records import MAGIC_PATHS, Spell, MageData
+
+# Mages of a nation only matter to first_in_second and first_in_second2
+NO_NATION = {'name': 'Check', 'epithet': 'Synthetic', 'nspells': [],
+             'fort_mages': [], 'cap_mages': [], 'hero_mages': [],
+             'uw_mages': []}
+
+
+def sorted_paths(paths):
+    return ''.join(sorted(paths, key=MAGIC_PATHS.index))
+
+def random_token(rnd):
+    """A random pick, like '100FWE', '10FAWESDNB' or '50SD*2'"""
+    letters = sorted_paths(rnd.sample(MAGIC_PATHS, rnd.randint(1, 5)))
+    percent = rnd.choice((10, 25, 50, 100, rnd.randint(1, 100)))
+    token = '{0}{1}'.format(percent, letters)
+    if rnd.random() < 0.1:
+        token += '*{0}'.format(rnd.randint(2, 3))
+    return token
+
+def random_paths(rnd):
+    """A mage path string: fixed paths, random picks, or both"""
+    fixed = sorted_paths(rnd.sample(MAGIC_PATHS, rnd.randint(0, 3)))
+    fixed = ''.join(path * rnd.randint(1, 3) for path in fixed)
+    tokens = [fixed] if fixed else []
+    for pick in range(rnd.randint(0 if fixed else 1, 4)):
+        tokens.append(random_token(rnd))
+    return ','.join(tokens)
+
+def related_paths(rnd, paths):
+    """Paths of a mage with at least the paths and picks of 'paths', so that
+    first_in_second has something to find"""
+    tokens = paths.split(',')
+    fixed = tokens.pop(0) if tokens[0].isalpha() else ''
+    if rnd.random() < 0.5:
+        fixed = sorted_paths(fixed + rnd.choice(MAGIC_PATHS))
+    if rnd.random() < 0.5:
+        tokens.insert(rnd.randint(0, len(tokens)), random_token(rnd))
+    return ','.join(([fixed] if fixed else []) + tokens)
+
+def random_spells(rnd, count):
+    """Spells needing one or two paths, up to level 6 and 3"""
+    result = []
+    for nr in range(count):
+        path1 = rnd.choice(MAGIC_PATHS) * rnd.randint(1, 6)
+        path2 = ''
+        if rnd.random() < 0.4:
+            path2 = rnd.choice(MAGIC_PATHS) * rnd.randint(1, 3)
+        result.append(Spell('s{0}'.format(nr), 'Spell {0}'.format(nr), path1,
+                            path2, 0, rnd.choice(('battle', 'ritual')), '',
+                            ''))
+    return result
+
+def random_boosts(rnd, count):
+    """Packed boosts of booster items, like those of 'FF' or 'FAWE'"""
+    return [core.packed_levels(rnd.choice(MAGIC_PATHS) * rnd.randint(1, 2)
+                               if rnd.random() < 0.7 else
+                               ''.join(rnd.sample(MAGIC_PATHS, 4)))
+            for n in range(count)]
+
+
+# References: the first versions of the engines, on plain strings
+
+def reference_unpacked(token):
+    """ 100FEDN*2 """
+    result = []
+    parts = token.partition('*')
+    bonus_size = parts[2] # Rare cases like King of the Deep
+    bonus_size = 1 if not bonus_size else int(bonus_size)
+    bonus_chance = Frac(int(parts[0].strip(string.ascii_letters)), 100)
+    bonus_letters = parts[0].strip(string.digits)
+    letter_chance = bonus_chance / len(bonus_letters)
+    for letter in bonus_letters:
+        result.append((letter * bonus_size, letter_chance))
+    if bonus_chance < 1:
+        result.append(('', 1 - bonus_chance))
+    return result
+
+def reference_variants(paths):
+    """Returns (prefix, [(paths, chance), ...]), likeliest first"""
+    tokens = paths.split(',') # 'FWWEEE,100FWE,10FWE' for Basalt King
+    factors = [] # For cartesian product
+    prefix = ''
+    if tokens[0].isalpha():
+        prefix = tokens.pop(0)
+    factors.append([(prefix, Frac(1, 1))])
+    for token in tokens:
+        factors.append(reference_unpacked(token))
+    while len(factors) > 1:
+        first, second = factors.pop(0), factors.pop(0)
+        product = [(f[0] + s[0], f[1] * s[1]) for f in first for s in second]
+        product = [(sorted_paths(paths), chance) for paths, chance in product]
+        factors.insert(0, product)
+    reduced = dict()
+    for paths, chance in factors[0]:
+        reduced[paths] = reduced.get(paths, 0) + chance
+    variants = sorted(reduced.items(), key=itemgetter(1), reverse=True)
+    assert sum(chance for paths, chance in variants) == 1
+    return prefix, variants
+
+def reference_meta(prefix, variants):
+    """Returns (meta of the prefix, [meta of each variant, ...])"""
+    result = []
+    prefix_in_variants = False
+    for paths, chance in variants:
+        if len(variants) == 1:
+            result.append('(The sole variant)')
+            prefix_in_variants = True
+        elif paths == prefix and paths:
+            result.append('({} chance) (Common to all)'.format(chance))
+            prefix_in_variants = True
+        else:
+            result.append('({} chance)'.format(chance))
+    if not prefix_in_variants:
+        return "(Doesn't occur) (Common to all)", result
+    return '', result
+
+def reference_can_cast(paths, spell):
+    for path in (spell.path1, spell.path2):
+        if path not in paths:
+            return False
+    return True
+
+def reference_castable(paths, spells):
+    return {sp.hash for sp in spells if reference_can_cast(paths, sp)}
+
+def reference_chances(paths, spells, castable=None):
+    """{hash: chance_to_cast} of the spells a mage might cast
+    castable - reference_castable of a variant's paths and the spells, if
+               worked out already"""
+    chances = dict()
+    for var_paths, chance in reference_variants(paths)[1]:
+        for h in (castable(var_paths) if castable else
+                  reference_castable(var_paths, spells)):
+            chances[h] = chances.get(h, 0) + chance
+    return chances
+
+def reference_boosted(paths, boost):
+    """Variant paths with a booster item: only paths it has are raised"""
+    added = ''.join(MAGIC_PATHS[nr] * level
+                    for nr, level in core.path_levels(boost)
+                    if MAGIC_PATHS[nr] in paths)
+    return sorted_paths(paths + added)
+
+def reference_first_in_second(first, second):
+    if len(first) > len(second):
+        return False
+    if first == second: # correct, but pointless.
+        return False
+    tokens1 = first.split(',')
+    tokens2 = second.split(',')
+    prefix1 = tokens1.pop(0) if tokens1[0].isalpha() else ''
+    prefix2 = tokens2.pop(0) if tokens2[0].isalpha() else ''
+    groups1 = [''.join(list(b)) for a, b in groupby(prefix1)]
+    for gr in groups1:
+        if gr not in prefix2:
+            return False
+    for tk1 in tokens1:
+        if tk1 not in tokens2:
+            return False
+        tokens2.remove(tk1) # FN,10FEDN,10FEDN would fit FN,10FEDN,10SWE !
+    return True
+
+def reference_first_in_second2(first, second):
+    """first, second - reference_chances of two mages"""
+    return all(chance <= second.get(h, 0) for h, chance in first.items())
+
+
+# Checks, each returning descriptions of mismatches
+
+class References:
+    """Reference results for the spells, worked out once per paths string,
+    since variants and mages of the checks often share their paths"""
+    def __init__(self, spells):
+        self.spells = spells
+        self.castable_of = dict()
+        self.chances_of = dict()
+
+    def castable(self, paths):
+        if paths not in self.castable_of:
+            self.castable_of[paths] = reference_castable(paths, self.spells)
+        return self.castable_of[paths]
+
+    def chances(self, paths):
+        if paths not in self.chances_of:
+            self.chances_of[paths] = reference_chances(paths, self.spells,
+                                                       self.castable)
+        return self.chances_of[paths]
+
+def check_variants(mage):
+    problems = []
+    prefix, expected = reference_variants(mage.paths)
+    prefix_meta, metas = reference_meta(prefix, expected)
+    got = [(var.paths, var.chance) for var in mage.variants]
+    if got != expected:
+        problems.append('variants of {0!r}: {1} instead of {2}'.format(
+            mage.paths, got, expected))
+    if [var.meta for var in mage.variants] != metas:
+        problems.append('meta of {0!r}: {1} instead of {2}'.format(
+            mage.paths, [var.meta for var in mage.variants], metas))
+    if (mage.prefix.paths, mage.prefix.meta) != (prefix, prefix_meta):
+        problems.append('prefix of {0!r}: {1!r} instead of {2!r}'.format(
+            mage.paths, (mage.prefix.paths, mage.prefix.meta),
+            (prefix, prefix_meta)))
+    for var in mage.variants:
+        if (Frac(var.weight, mage.denominator) != var.chance or
+                var.levels != core.packed_levels(var.paths)):
+            problems.append('weight or levels of {0!r} in {1!r}'.format(
+                var.paths, mage.paths))
+    cached = core.Mage(mage.paths, mage.name)
+    if ([(var.paths, var.chance, var.meta, var.weight)
+         for var in cached.variants] !=
+            [(var.paths, var.chance, var.meta, var.weight)
+             for var in mage.variants]):
+        problems.append('cached variants of {0!r} differ'.format(mage.paths))
+    return problems
+
+def check_castability(mages, references, boosts):
+    problems = []
+    spells = references.spells
+    matrix = core.CastabilityMatrix(spells, mages)
+    for mage in mages:
+        expected = references.chances(mage.paths)
+        for sp in spells:
+            chance = expected.get(sp.hash, 0)
+            if (mage.chance_to_cast(sp) != chance or
+                    mage.chance_to_cast(sp, matrix) != chance):
+                problems.append('chance of {0!r} to cast {1}: {2} and {3} '
+                                'instead of {4}'.format(
+                                    mage.paths, sp.paths,
+                                    mage.chance_to_cast(sp),
+                                    mage.chance_to_cast(sp, matrix), chance))
+        if mage.possible_spells(matrix) != set(expected):
+            problems.append('possible spells of {0!r} differ'.format(
+                mage.paths))
+        for var in mage.variants:
+            castable = references.castable(var.paths)
+            if (matrix.hashes_in(matrix.row(var)) != castable or
+                    {sp.hash for sp in spells
+                     if mage.can_cast(var, sp)} != castable):
+                problems.append('spells of variant {0!r} differ'.format(
+                    var.paths))
+            for boost in boosts:
+                boosted = reference_boosted(var.paths, boost)
+                usable = core.usable_boost(var.levels, boost)
+                got = matrix.hashes_in(matrix.boosted_row(var, usable))
+                if got != references.castable(boosted):
+                    problems.append('spells of variant {0!r} boosted to {1!r} '
+                                    'differ'.format(var.paths, boosted))
+    return problems
+
+def check_dominance(pairs, references):
+    problems = []
+    nation = core.Nation(NO_NATION, {})
+    matrix = core.CastabilityMatrix(references.spells)
+    for first, second in pairs:
+        for one, other in ((first, second), (second, first)):
+            if (nation.first_in_second(one, other) !=
+                    reference_first_in_second(one.paths, other.paths)):
+                problems.append('first_in_second({0!r}, {1!r})'.format(
+                    one.paths, other.paths))
+            if (nation.first_in_second2(one, other, matrix) !=
+                    reference_first_in_second2(references.chances(one.paths),
+                                               references.chances(
+                                                   other.paths))):
+                problems.append('first_in_second2({0!r}, {1!r})'.format(
+                    one.paths, other.paths))
+    return problems
+
+
+def matrix_chances(spells, mages):
+    matrix = core.CastabilityMatrix(spells, mages)
+    return [matrix.chances(mage) for mage in mages]
+
+def time_engines(paths, spells, repeat):
+    """Best times of the optimized engines and of their references.
+    Returns (timings, the Mages timed)"""
+    timings = dict()
+    mage_data = [MageData('Synthetic', p, 0) for p in paths]
+    timings['generate_variants'], mages = best_time(
+        lambda: fresh_mages(mage_data), repeat)
+    timings['generate_variants_reference'], unused = best_time(
+        lambda: [reference_variants(p) for p in paths], repeat)
+    timings['chances'], unused = best_time(
+        lambda: matrix_chances(spells, mages), repeat)
+    timings['chances_reference'], unused = best_time(
+        lambda: [reference_chances(p, spells) for p in paths], repeat)
+    return timings, mages
+
+def check_timed(timed, mages):
+    """The timed mages must be the checked ones, variants and all"""
+    problems = []
+    for mage, checked in zip(timed, mages):
+        if mage.paths != checked.paths or (
+                [(var.paths, var.chance) for var in mage.variants] !=
+                [(var.paths, var.chance) for var in checked.variants]):
+            problems.append('timed mage {0!r} is not the checked {1!r}'.format(
+                mage.paths, checked.paths))
+    if len(timed) != len(mages):
+        problems.append('{0} mages timed instead of {1}'.format(len(timed),
+                                                               len(mages)))
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Checks optimized engines against reference ones, on '
+        'random mages and spells.')
+    parser.add_argument('--mages', type=int, default=200,
+                        help='number of random mage path strings')
+    parser.add_argument('--spells', type=int, default=200,
+                        help='number of random spells')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='timed runs of each engine, the best one counts')
+    parser.add_argument('--min-speedup', type=float,
+                        help='fail if an optimized engine is not this many '
+                        'times faster than its reference')
+    parser.add_argument('-o', '--output',
+                        help='file to write the timings to, for bench.py '
+                        '--compare')
+    args = parser.parse_args()
+    rnd = random.Random(args.seed)
+    paths = [random_paths(rnd) for n in range(args.mages)]
+    spells = random_spells(rnd, args.spells)
+    boosts = random_boosts(rnd, 3)
+
+    core.variant_cache.entries = dict() # Generated here, not taken from it
+    mages = [core.Mage(p, 'Synthetic') for p in paths]
+    problems = []
+    for mage in mages:
+        problems.extend(check_variants(mage))
+    references = References(spells)
+    problems.extend(check_castability(mages, references, boosts))
+    pairs = [(mage, core.Mage(related_paths(rnd, mage.paths), 'Related'))
+             for mage in mages]
+    problems.extend(check_dominance(pairs, references))
+    timings, timed = time_engines(paths, spells, args.repeat)
+    problems.extend(check_timed(timed, mages))
+    for problem in problems[:20]:
+        print('MISMATCH', problem)
+    print('{0} mages, {1} spells, seed {2}: {3} mismatch(es)'.format(
+        args.mages, args.spells, args.seed, len(problems)))
+
+    slow = []
+    for engine in ('generate_variants', 'chances'):
+        speedup = (timings[engine + '_reference'] /
+                   max(timings[engine], 1e-9))
+        print('{0:20} {1:10.6f}  reference {2:10.6f}  {3:6.2f}x'.format(
+            engine, timings[engine], timings[engine + '_reference'],
+            speedup))
+        if args.min_speedup and speedup < args.min_speedup:
+            slow.append(engine)
+    if args.output:
+        results = {'meta': {'python': platform.python_version(),
+                            'machine': platform.machine(),
+                            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                            'mages': args.mages, 'spells': args.spells,
+                            'seed': args.seed, 'repeat': args.repeat},
+                   'timings': timings}
+        with open(args.output, 'w') as outfile:
+            json.dump(results, outfile, sort_keys=True, indent=4)
+    if slow:
+        print('Slower than {0}x: {1}'.format(args.min_speedup,
+                                             ', '.join(slow)))
+    sys.exit(1 if problems or slow else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+#! /usr/bin/env python3
+#
+# Checks of server.py through a local client. The server is started on a
+# temporary Unix socket and asked every query, then the errors: unknown
+# names, bad parameters, other methods and a failing query. Same requests
+# for one nation, sent at once, must be rendered once. Failed checks are
+# printed and the exit status is 1. The traceback of the failing query is
+# expected.
+#
+# Usage: ./check_server.py [--data gamedata.json]
+#
+import os
+import sys
+import json
+import asyncio
+import argparse
+import tempfile
+from collections import Counter
+from urllib.parse import quote
+
+import core
+import server
+
+
+class Broken:
+    """A dataset whose queries fail with an unexpected error"""
+    def answer(self, path, query):
+        raise RuntimeError('broken on purpose')
+
+
+async def request(socket_path, target, method='GET'):
+    """Returns (status, body) of one request"""
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    writer.write('{0} {1} HTTP/1.1\r\nHost: localhost\r\n\r\n'.format(
+        method, target).encode('latin-1'))
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, sep, body = response.partition(b'\r\n\r\n')
+    return int(head.split()[1]), body.decode('utf-8')
+
+async def run_checks(data, socket_path):
+    """Returns descriptions of failed checks"""
+    failed = []
+    def check(target, status, expected, got):
+        if got != (status, expected):
+            failed.append('{0}: {1!r} instead of {2!r}'.format(
+                target, got, (status, expected)))
+
+    ndata = data['nations'][0]
+    nation = '{0}: {1}'.format(ndata['name'], ndata['epithet'])
+    mage_id = (ndata['fort_mages'] + ndata['cap_mages'])[0]
+    md = data['mages'][mage_id]
+    mage = core.Mage(md.paths, md.name, md.gcost)
+    spell = data['spells'][0]
+    index = core.SpellIndex(data)
+    names = sorted({'{0}: {1}'.format(n['name'], n['epithet'])
+                    for n in data['nations']})
+
+    checks = [
+        ('/datasets', 200, json.dumps(['data', 'broken'])),
+        ('/nations', 200, json.dumps(names)),
+        ('/nation?name={0}&format=reST'.format(quote(nation)), 200,
+         core.render_nation(data, ndata)),
+        ('/nation?name={0}&format=csv&dominance=chance'.format(quote(nation)),
+         200, core.render_nation(data, ndata, 'chance', 'csv')),
+        ('/nation?name={0}'.format(quote(nation)), 200,
+         core.render_nation(data, ndata, fmt='json')),
+        ('/chance?mage={0}&spell={1}'.format(mage_id, spell.hash), 200,
+         json.dumps({'mage': str(mage), 'spell': spell.name,
+                     'hash': spell.hash,
+                     'chance': str(mage.chance_to_cast(spell))},
+                    sort_keys=True)),
+        ('/variants?mage={0}'.format(mage_id), 200,
+         json.dumps({'mage': str(mage), 'variants': [
+             {'paths': var.paths, 'chance': str(var.chance),
+              'meta': var.meta} for var in mage.variants]}, sort_keys=True)),
+        ('/who-casts?spell={0}'.format(spell.hash), 200, json.dumps([
+            {'nation': '{0}: {1}'.format(n['name'], n['epithet']),
+             'mage': str(m), 'chance': str(chance)}
+            for n, m, chance in index.who_can_cast(spell.hash)],
+            sort_keys=True)),
+        ('/nation?name=Nope', 404,
+         json.dumps({'error': 'No such nation: Nope'})),
+        ('/nation?name={0}&format=xml'.format(quote(nation)), 400,
+         json.dumps({'error': 'Unknown format or dominance'})),
+        ('/chance?mage=%C2%B2&spell={0}'.format(spell.hash), 404,
+         json.dumps({'error': 'No such mage: ²'})),
+        ('/variants?mage=0', 404, json.dumps({'error': 'No such mage: 0'})),
+        ('/who-casts?spell=Nope', 404,
+         json.dumps({'error': 'No such spell: Nope'})),
+        ('/nope', 404, json.dumps({'error': 'No such query: /nope'})),
+        ('/nations?dataset=nope', 404,
+         json.dumps({'error': 'No such dataset: nope'})),
+        ('/nations?dataset=broken', 500,
+         json.dumps({'error': 'Internal error'})),
+    ]
+    for target, status, expected in checks:
+        check(target, status, expected, await request(socket_path, target))
+    check('POST /nations', 405,
+          json.dumps({'error': 'Only GET requests are served'}),
+          await request(socket_path, '/nations', 'POST'))
+
+    # Clients asking for the same report at once wait for one rendering
+    rendered = Counter()
+    spells_by_mage = core.Nation.spells_by_mage
+    def counted(self, *args, **kwargs):
+        rendered[str(self)] += 1
+        return spells_by_mage(self, *args, **kwargs)
+    core.Nation.spells_by_mage = counted
+    try:
+        other = data['nations'][1]
+        target = '/nation?name={0}&dominance=chance'.format(
+            quote('{0}: {1}'.format(other['name'], other['epithet'])))
+        answers = await asyncio.gather(*[request(socket_path, target)
+                                         for n in range(8)])
+    finally:
+        core.Nation.spells_by_mage = spells_by_mage
+    check(target + ' x8', 200, core.render_nation(data, other, 'chance',
+                                                  'json'), answers[0])
+    if len(set(answers)) != 1 or sum(rendered.values()) != 1:
+        failed.append('{0}: {1} different answers, rendered {2} '
+                      'time(s)'.format(target, len(set(answers)),
+                                       sum(rendered.values())))
+    return failed
+
+async def serve_and_check(data, socket_path):
+    datasets = {'data': server.Queries(data), 'broken': Broken()}
+    serving = asyncio.ensure_future(server.serve(datasets,
+                                                 socket_path=socket_path))
+    while not os.path.exists(socket_path):
+        if serving.done():
+            serving.result() # Raises whatever stopped the server
+        await asyncio.sleep(0.01)
+    try:
+        return await run_checks(data, socket_path)
+    finally:
+        serving.cancel()
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Checks the answers of server.py on a Unix socket.')
+    parser.add_argument('--data', default=core.default_datafile(),
+                        help='gamedata.json or gamedata.bin')
+    args = parser.parse_args()
+    data = core.load_gamedata(args.data)
+    with tempfile.TemporaryDirectory() as tmp:
+        failed = asyncio.run(serve_and_check(data,
+                                             os.path.join(tmp, 'server.sock')))
+    core.variant_cache.save()
+    for failure in failed:
+        print('FAILED', failure)
+    print('server.py: {0} failed check(s)'.format(len(failed)))
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -18,16 +18,35 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
+import io
+import os
+import sys
+import csv
+import argparse
+import multiprocessing
 import string
 import json
-from itertools import groupby, product, zip_longest
+import time
+import pickle
+import cProfile
+import hashlib
+from collections import Counter
+from itertools import groupby, zip_longest
 from fractions import Fraction as Frac
 from operator import itemgetter, attrgetter
+from functools import partial
 
-MAGIC_PATHS = 'FAWESDNBH' # Sort order, etc
+import gamedata_bin
+from records import (MAGIC_PATHS, LEVEL_BITS, LEVEL_GUARD, packed_levels,
+                     Item, Spell, MageData, Variant, Interner, from_fields)
 
-with open('gamedata.json', 'r') as datafile:
-    data = json.load(datafile)
+# Counts of hot path events, reported by profile_report(). Variants are
+# counted for cached mages too, so warm runs report as much as cold ones;
+# matrix rows only count lookups of the analysis (CastabilityMatrix.row).
+stats = Counter()
+STATS = ('can_cast', 'variants_generated', 'variants_kept',
+         'variant_cache_hits', 'variant_cache_misses', 'matrix_builds',
+         'matrix_row_hits', 'matrix_row_misses')
 
 def human(paths):
     if not paths.startswith(tuple(MAGIC_PATHS)):
@@ -37,9 +56,33 @@ def human(paths):
     humanized = ''.join([a + str(len(list(b))) for a, b in groupby(fixed)])
     return paths.replace(fixed, humanized)
 
-def sort_func(dic):
-    combined = dic['path1']+dic['path2']
-    return (len(combined), combined)
+def covers(levels, req):
+    """True if every path level in 'levels' is at least the one in 'req'.
+    Guard bits stop borrows from crossing into the neighbouring path."""
+    return ((levels | LEVEL_GUARD) - req) & LEVEL_GUARD == LEVEL_GUARD
+
+def path_levels(packed):
+    """Inverse of packed_levels: [(path number, level), ...] of levels > 0"""
+    result = []
+    nr = 0
+    while packed:
+        level = packed & ((1 << LEVEL_BITS) - 1)
+        if level:
+            result.append((nr, level))
+        packed >>= LEVEL_BITS
+        nr += 1
+    return result
+
+def usable_boost(levels, boost):
+    """Part of boost (packed like levels) a mage with 'levels' gets from
+    a booster item: only paths the mage already has are raised"""
+    usable = 0
+    for nr, level in path_levels(boost):
+        if levels >> (LEVEL_BITS * nr) & ((1 << LEVEL_BITS) - 1):
+            usable |= level << (LEVEL_BITS * nr)
+    return usable
+
+sort_func = attrgetter('sort_key') # (len(paths), paths), see records.Item
 
 def spell_columns(spells):
     """Returns spells divided into two columns:
@@ -47,23 +90,194 @@ def spell_columns(spells):
     - rituals&forgings"""
     left, right = [], []
     for sp in spells:
-        if sp['mode'] in ('ritual', 'forge'):
+        if sp.mode in ('ritual', 'forge'):
             right.append(sp)
         else:
             left.append(sp)
     return (left, right)
 
-def reST_words(spells):
-    """[{spell:1}, {spell:2}] ---> [['paths1', 'name1'], ['paths2', 'name2']]
-    """
-    spells = [(sp['path1']+sp['path2'], sp['gems'], 
-               sp['name'].replace("'", "\\\'"),
-               sp['level'], sp['boosts']) for sp in spells]
-    max_widths = [max([len(word) for word in col]) for col in zip(*spells)]
-    max_widths = [max(2, width) for width in max_widths]
-    spells = [[word.ljust(max_widths[nr]) for nr, word in enumerate(row)]
-                 for row in spells]
-    return spells
+def set_bits(mask):
+    """0b10110 ---> 1, 2, 4"""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+def spell_words(spell):
+    """{spell} ---> ['paths', 'gems', 'name', 'level', 'boosts']"""
+    return [spell.paths, spell.gems, spell.name.replace("'", "\\\'"),
+            spell.level, spell.boosts]
+
+def column_widths(rows):
+    """Widths of reST table columns, at least 2 characters each"""
+    return [max(2, max(map(len, column))) for column in zip(*rows)]
+
+
+class CastabilityMatrix:
+    """Which spells (columns) each mage variant (row) can cast.
+
+    A row is a bitset over the columns. Rows are keyed by packed path levels,
+    so variants with the same paths share one row even across mages. Columns
+    are kept in sort_func order, so masking a row gives an already sorted
+    list of spells."""
+    def __init__(self, spells, mages=()):
+        self.spells = sorted(spells, key=sort_func, reverse=True)
+        self.columns = {sp.hash: nr for nr, sp in enumerate(self.spells)}
+        self.by_req = dict() # Spells sharing requirements share one test
+        for nr, sp in enumerate(self.spells):
+            self.by_req[sp.req] = self.by_req.get(sp.req, 0) | 1 << nr
+        self.by_path_level = None # See boosted_row()
+        self.rows = dict()
+        self.looked_up = set() # Levels whose rows row() returned, for stats
+        self.mage_masks = dict() # Both keyed by mage paths
+        self.mage_chances = dict()
+        for mage in mages:
+            for var in mage.variants:
+                self._row(var.levels)
+
+    def _row(self, levels):
+        if levels not in self.rows:
+            stats['can_cast'] += len(self.by_req)
+            mask = 0
+            for req, columns in self.by_req.items():
+                if covers(levels, req):
+                    mask |= columns
+            self.rows[levels] = mask
+        return self.rows[levels]
+
+    def _count_lookup(self, levels):
+        """Rows made in advance, or for mage_mask() and chances(), still
+        count as misses the first time the analysis needs them"""
+        if levels in self.looked_up:
+            stats['matrix_row_hits'] += 1
+        else:
+            stats['matrix_row_misses'] += 1
+            self.looked_up.add(levels)
+
+    def row(self, variant):
+        self._count_lookup(variant.levels)
+        return self._row(variant.levels)
+
+    def boosted_row(self, variant, boost):
+        """row() of the variant with path levels raised by boost, packed
+        like levels. Worked out from the variant's own row: only
+        requirements needing more of a raised path than it has are tested."""
+        if self.by_path_level is None:
+            self.by_path_level = dict() # (path number, level) ---> reqs
+            for req in self.by_req:
+                for path_level in path_levels(req):
+                    self.by_path_level.setdefault(path_level, []).append(req)
+        levels = variant.levels + boost
+        self._count_lookup(levels)
+        if levels not in self.rows:
+            mask = self._row(variant.levels)
+            for nr, extra in path_levels(boost):
+                have = variant.levels >> (LEVEL_BITS * nr) & (
+                    (1 << LEVEL_BITS) - 1)
+                for level in range(have + 1, have + extra + 1):
+                    for req in self.by_path_level.get((nr, level), ()):
+                        stats['can_cast'] += 1
+                        if covers(levels, req):
+                            mask |= self.by_req[req]
+            self.rows[levels] = mask
+        return self.rows[levels]
+
+    def mage_mask(self, mage):
+        """Spells castable by at least one variant of the mage"""
+        if mage.paths not in self.mage_masks:
+            mask = 0
+            for var in mage.variants:
+                mask |= self._row(var.levels)
+            self.mage_masks[mage.paths] = mask
+        return self.mage_masks[mage.paths]
+
+    def chances(self, mage):
+        """{column: chance_to_cast} of the spells the mage might cast, as
+        weights over mage.denominator"""
+        if mage.paths not in self.mage_chances:
+            chances = dict()
+            for var in mage.variants:
+                for nr in set_bits(self._row(var.levels)):
+                    chances[nr] = chances.get(nr, 0) + var.weight
+            self.mage_chances[mage.paths] = chances
+        return self.mage_chances[mage.paths]
+
+    def mask_of(self, hashes):
+        mask = 0
+        for h in hashes:
+            if h in self.columns:
+                mask |= 1 << self.columns[h]
+        return mask
+
+    def spells_in(self, mask):
+        return [self.spells[nr] for nr in set_bits(mask)]
+
+    def hashes_in(self, mask):
+        return {self.spells[nr].hash for nr in set_bits(mask)}
+
+
+def as_matrix(spells):
+    if isinstance(spells, CastabilityMatrix):
+        return spells
+    return CastabilityMatrix(spells)
+
+
+class VariantCache:
+    """Reduced and annotated variants of mages, keyed by the paths string.
+
+    Entries live in memory and can be pickled next to the game data file.
+    A stored cache is ignored if it was made from a different data file."""
+    VERSION = 4 # Bump when the layout of variants changes
+
+    def __init__(self):
+        self.entries = dict()
+        self.filename = None
+        self.digest = None
+        self.changed = False
+
+    def attach(self, datafile, raw_data):
+        """Use the cache file belonging to 'datafile' from now on"""
+        self.filename = os.path.splitext(datafile)[0] + '.variants.pickle'
+        self.digest = hashlib.sha1(raw_data).hexdigest()
+        try:
+            with open(self.filename, 'rb') as cachefile:
+                stored = pickle.load(cachefile)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return
+        if stored.get('key') == (self.VERSION, self.digest):
+            stored['entries'].update(self.entries)
+            self.entries = stored['entries']
+
+    def save(self):
+        if not self.changed or self.filename is None:
+            return
+        stored = {'key': (self.VERSION, self.digest), 'entries': self.entries}
+        tmp_name = self.filename + '.tmp'
+        try:
+            with open(tmp_name, 'wb') as cachefile:
+                pickle.dump(stored, cachefile, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_name, self.filename)
+        except OSError:
+            return # The cache is optional, e.g. next to read-only data
+        self.changed = False
+
+    def get(self, paths):
+        """Returns copies of (prefix, variants, denominator, combinations),
+        or None. combinations is the number of variants generated."""
+        if paths not in self.entries:
+            stats['variant_cache_misses'] += 1
+            return None
+        stats['variant_cache_hits'] += 1
+        prefix, variants, denominator, combinations = self.entries[paths]
+        return (prefix.copy(), [var.copy() for var in variants], denominator,
+                combinations)
+
+    def put(self, paths, prefix, variants, denominator, combinations):
+        self.entries[paths] = (prefix.copy(), [var.copy() for var in variants],
+                               denominator, combinations)
+        self.changed = True
+
+variant_cache = VariantCache()
 
 
 class Mage:
@@ -80,17 +294,18 @@ class Mage:
                 human(self.paths), self.gcost)
 
     def can_cast(self, variant, spell):
-        for path in (spell['path1'], spell['path2']):
-            if path not in variant['paths']:
-                return False
-        return True
+        stats['can_cast'] += 1
+        return covers(variant.levels, spell.req)
 
-    def chance_to_cast(self, spell):
-        chance = 0
-        for v in self.get_variants(add_prefix=False):
-            if self.can_cast(v, spell):
-                chance += v['chance']
-        return chance
+    def chance_to_cast(self, spell, matrix=None):
+        weight = 0
+        if matrix is None:
+            for v in self.get_variants(add_prefix=False):
+                if self.can_cast(v, spell):
+                    weight += v.weight
+        else:
+            weight = matrix.chances(self).get(matrix.columns[spell.hash], 0)
+        return Frac(weight, self.denominator)
 
     def only_castable(self, variant, spells):
         spells = [spell for spell in spells if self.can_cast(variant, spell)]
@@ -102,21 +317,46 @@ class Mage:
             print(line)
 
 
-    def spells_by_variant(self, spells, each_spell_once=True, ignored=set()):
+    def spells_by_variant(self, spells, each_spell_once=True, ignored=set(),
+                          boosters=()):
+        """spells - list of spells or a CastabilityMatrix
+           ignored - hashes of spells to leave out, or a mask of the matrix
+           boosters - [(packed boost, [items]), ...]; each one that lets a
+                      variant cast more spells adds a variant after the
+                      others, with only the spells it adds"""
+        matrix = as_matrix(spells)
         result = []
-        dont_repeat = set() 
-        for var in self.get_variants():
-            chance = var['chance']
-            castable = self.only_castable(var, spells)
-            if ignored:
-                castable = [sp for sp in castable
-                        if sp['hash'] not in ignored]
+        if not isinstance(ignored, int):
+            ignored = matrix.mask_of(ignored)
+        dont_repeat = 0
+        variants = self.get_variants()
+        rows = [matrix.row(var) for var in variants]
+        for var, row in zip(variants, rows):
+            castable = row & ~ignored
             if each_spell_once:
-                castable = [sp for sp in castable 
-                        if sp['hash'] not in dont_repeat]
-                for sp in castable:
-                    dont_repeat.add(sp['hash'])
-            result.append((var, castable))
+                castable &= ~dont_repeat
+                dont_repeat |= castable
+            result.append((var, matrix.spells_in(castable)))
+        for var, row in zip(variants, rows):
+            for boost, items in boosters:
+                boost = usable_boost(var.levels, boost)
+                if not boost:
+                    continue
+                castable = matrix.boosted_row(var, boost) & ~row & ~ignored
+                if each_spell_once:
+                    castable &= ~dont_repeat
+                    dont_repeat |= castable
+                if not castable:
+                    continue
+                added = ''.join(MAGIC_PATHS[nr] * level
+                                for nr, level in path_levels(boost))
+                paths = ''.join(sorted(var.paths + added,
+                                       key=MAGIC_PATHS.index))
+                meta = '({0} chance) (With {1})'.format(
+                    var.chance, ' or '.join(it.name for it in items))
+                result.append((Variant(paths, var.chance, meta,
+                                       var.levels + boost),
+                               matrix.spells_in(castable)))
         return result
     
 
@@ -131,84 +371,101 @@ class Mage:
 
 
     def unpacked(self, token): 
-        """ 100FEDN*2 """
+        """ 100FEDN*2 ---> ([(bonus, weight), ...], denominator)
+        The chance of a bonus is its weight / denominator."""
         result = []
         parts = token.partition('*')
         bonus_size = parts[2] # Rare cases like King of the Deep
         bonus_size = 1 if not bonus_size else int(bonus_size)
-        bonus_chance = Frac(int(parts[0].strip(string.ascii_letters)), 100)
+        percent = int(parts[0].strip(string.ascii_letters))
         bonus_letters = parts[0].strip(string.digits)
-        letter_chance = bonus_chance / len(bonus_letters)
+        denominator = 100 * len(bonus_letters) # percent / 100 per letter
         for letter in bonus_letters:
-            result.append((letter * bonus_size, letter_chance))
-        if bonus_chance < 1:
-            result.append(('', 1 - bonus_chance))
-        return result
+            result.append((letter * bonus_size, percent))
+        if percent < 100:
+            result.append(('', denominator - percent * len(bonus_letters)))
+        return result, denominator
 
     def generate_variants(self):
+        cached = variant_cache.get(self.paths)
+        if cached:
+            self.prefix, self.variants, self.denominator, combinations = cached
+            stats['variants_generated'] += combinations
+            stats['variants_kept'] += len(self.variants)
+            return
         tokens = self.paths.split(',') # 'FWWEEE,100FWE,10FWE' for Basalt King
-        factors = [] # For cartesian product
-        prefix = ('', Frac(1, 1))
+        prefix = ''
         if tokens[0].isalpha():
-            prefix = (tokens.pop(0), Frac(1, 1))
-        factors.append([prefix])
-        self.prefix = {'paths': prefix[0], 'chance': prefix[1], 'meta': ''}
+            prefix = tokens.pop(0)
+        # Distribution of sorted path strings. Equal outcomes are merged after
+        # each token, so this grows with distinct outcomes, not combinations.
+        # Chances are int weights over a common denominator, the product of
+        # those of the tokens; Fractions are only made by annotate_variants.
+        outcomes = {prefix: 1}
+        self.denominator = 1
+        combinations = 1 # What a cartesian product would have generated
         for token in tokens:
-            factors.append(self.unpacked(token))
-        while len(factors) > 1:
-            first, second = factors.pop(0), factors.pop(0)
-            product = [(f[0] + s[0], f[1] * s[1]) for f in first for s in second]
-            product = [(''.join(sorted(paths, key=MAGIC_PATHS.index)), chance)
-                                                  for paths, chance in product]
-            factors.insert(0, product)
-        self.variants = [{'paths': f[0], 'chance': f[1], 'meta': ''}
-                for f in factors[0]]
+            merged = dict()
+            bonuses, denominator = self.unpacked(token)
+            self.denominator *= denominator
+            combinations *= len(bonuses)
+            for paths, weight in outcomes.items():
+                for bonus, bonus_weight in bonuses:
+                    combined = ''.join(sorted(paths + bonus,
+                                              key=MAGIC_PATHS.index))
+                    merged[combined] = (merged.get(combined, 0) +
+                                        weight * bonus_weight)
+            outcomes = merged
+        self.prefix = Variant(prefix, Frac(1, 1), weight=self.denominator)
+        self.variants = [Variant(paths, weight=weight)
+                for paths, weight in outcomes.items()]
         self.reduce_variants()
+        stats['variants_generated'] += combinations
+        stats['variants_kept'] += len(self.variants)
         self.annotate_variants()
+        variant_cache.put(self.paths, self.prefix, self.variants,
+                          self.denominator, combinations)
 
     def annotate_variants(self):
         prefix_in_variants = False
         for var in self.variants:
+            var.chance = Frac(var.weight, self.denominator)
             if len(self.variants) == 1:
-                var['meta'] = '(The sole variant)'
+                var.meta = '(The sole variant)'
                 prefix_in_variants = True
-            elif var['paths'] == self.prefix['paths'] and var['paths']:
-                var['meta'] = '({} chance) (Common to all)'.format(var['chance'])
+            elif var.paths == self.prefix.paths and var.paths:
+                var.meta = '({} chance) (Common to all)'.format(var.chance)
                 prefix_in_variants = True
             else:
-                var['meta'] = '({} chance)'.format(var['chance'])
+                var.meta = '({} chance)'.format(var.chance)
         if not prefix_in_variants:
-            self.prefix['meta'] = "(Doesn't occur) (Common to all)"
+            self.prefix.meta = "(Doesn't occur) (Common to all)"
 
     def reduce_variants(self):
         tmp = dict()
         for v in self.variants:
-            paths = v['paths']
+            paths = v.paths
             if paths not in tmp:
                 tmp[paths] = v
             else:
-                tmp[paths]['chance'] += v['chance']
+                tmp[paths].weight += v.weight
 
         self.variants = [v for v in tmp.values()]
-        self.variants.sort(key=itemgetter('chance'), reverse=True)
+        self.variants.sort(key=attrgetter('weight'), reverse=True)
 
         # Sanity check:
-        total = sum(v['chance'] for v in self.variants)
+        total = Frac(sum(v.weight for v in self.variants), self.denominator)
         assert total == 1
 
     def get_variants(self, add_prefix=True):
-        if 'sole variant' not in self.prefix['meta'] or not add_prefix:
+        if 'sole variant' not in self.prefix.meta or not add_prefix:
             return self.variants
         return [self.prefix].extend(self.variants)
 
     def possible_spells(self, spells):
-        result = set()
-        for spell in spells:
-            for var in self.variants:
-                if self.can_cast(var, spell):
-                    result.add(spell['hash'])
-                    break
-        return result
+        """spells - list of spells or a CastabilityMatrix"""
+        matrix = as_matrix(spells)
+        return matrix.hashes_in(matrix.mage_mask(self))
 
 class Nation:
     def __init__(self, ndata, mages):
@@ -221,14 +478,16 @@ class Nation:
         for word in ('fort_mages', 'cap_mages', 'hero_mages', 'uw_mages'):
             x_mages = ndata[word]
             x_mages = [mages[xm] for xm in x_mages]
-            x_mages = [Mage(xm['paths'], xm['name'], xm['gcost'])
-                    for xm in x_mages]
+            x_mages = [Mage(xm.paths, xm.name, xm.gcost) for xm in x_mages]
             setattr(self, word, x_mages)
 
+        self.matrix, self.matrix_key = None, None
+        self.dominated = dict() # mode ---> result of dominance()
+        self.summoned = None # See summoned_mages()
         self.nsmages = []
         for spell in self.nspells:
-            if spell['sumages']:
-                self.nsmages.extend(spell['sumages'])
+            if spell.sumages:
+                self.nsmages.extend(spell.sumages)
         self.nsmages = [mages[ns] for ns in self.nsmages]
 
     def __str__(self):
@@ -248,6 +507,30 @@ class Nation:
         return mages 
 
 
+    def summoned_mages(self):
+        """Mages summoned by the nation's own spells (nsmages), once each"""
+        if self.summoned is None:
+            summoned = dict()
+            for md in self.nsmages:
+                if (md.name, md.paths) not in summoned:
+                    summoned[md.name, md.paths] = Mage(md.paths, md.name,
+                                                       md.gcost)
+            self.summoned = list(summoned.values())
+        return self.summoned
+
+    def boosters(self, spells):
+        """Booster items my_mages() might forge, grouped by the paths they
+        boost, easiest to forge first: [(packed boost, [items]), ...]"""
+        matrix = self.castability(spells)
+        forgeable = 0
+        for m in self.my_mages():
+            forgeable |= matrix.mage_mask(m)
+        grouped = dict()
+        for item in sorted(matrix.spells_in(forgeable), key=sort_func):
+            if item.mode == 'forge' and item.boosts:
+                grouped.setdefault(packed_levels(item.boosts), []).append(item)
+        return list(grouped.items())
+
     def first_in_second(self, first, second):
         if len(first.paths) > len(second.paths):
             return False
@@ -269,76 +552,738 @@ class Nation:
 
 
     def first_in_second2(self, first, second, spells):
-        for spell in spells:
-            if first.chance_to_cast(spell) > second.chance_to_cast(spell):
+        """spells - list of spells or a CastabilityMatrix"""
+        matrix = as_matrix(spells)
+        if matrix.mage_mask(first) & ~matrix.mage_mask(second):
+            return False # first might cast something second never can
+        theirs = matrix.chances(second)
+        for nr, weight in matrix.chances(first).items():
+            # Chances of both, over the product of their denominators
+            if weight * second.denominator > theirs[nr] * first.denominator:
                 return False
         return True
 
-    def print_spells_by_mage(self, spells, two_columns=True, fmt='reST'):
-        by_mage = self.spells_by_mage(spells)
-        for mage, by_variant, includes in by_mage:
-            m = str(mage)
-            print(m)
-            print('=' * len(m))
-            if includes:
-                includes = ', '.join(includes)
-                includes = ' and'.join(includes.rsplit(',', 1))
-                print('Omitting spells from {0}.'.format(includes))
-            print()
-            for var, sps in by_variant:
-                print('Variant {0} {1}:'.format(human(var['paths']), var['meta']))
-                if not sps:
-                    print()
-                    continue
-                col1, col2 = spell_columns(sps)
-                col1 = reST_words(col1)
-                col2 = reST_words(col2)
-                if len(col1) > len(col2):
-                    words = col2[0] if col2 else col1[0]
-                    fill = ['\\'.ljust(len(word)) for word in words]
-                else:
-                    words = col1[0] if col1 else col2[0]
-                    fill = ['\\'.ljust(len(word)) for word in words]
-                lines = zip_longest(col1, col2, fillvalue = fill)
-                lines = [left + right for left, right in lines]
-                border = ['=' * len(word) for word in lines[0]]
-                lines.insert(0, border)
-                lines.append(border)
-                lines = [' '.join(line) for line in lines]
-                for line in lines:
-                    print(' '*2 + line)
-                print()
-
-
-    def spells_by_mage(self, spells):
+    def castability(self, spells):
+        """CastabilityMatrix of my_mages(), reused while spells are the same"""
+        key = tuple(sp.hash for sp in spells)
+        if self.matrix_key != key:
+            stats['matrix_builds'] += 1
+            self.matrix = CastabilityMatrix(spells, self.my_mages())
+            self.matrix_key = key
+            self.dominated = dict()
+        return self.matrix
+
+    def dominance(self, spells, mode='paths'):
+        """Returns {mage: [recruitable mages whose spells it also has]} for
+        my_mages(). A mage's own spells are listed without theirs.
+        mode - 'paths': first has a subset of second's path tokens
+               'chance': first is never likelier to cast a spell"""
+        matrix = self.castability(spells)
+        if mode in self.dominated:
+            return self.dominated[mode]
+        if mode == 'paths':
+            dominates = self.first_in_second
+        else:
+            dominates = lambda o, m: (matrix.mage_mask(o) and
+                                      self.first_in_second2(o, m, matrix))
+        recruitable = self.recruitable_mages()
+        position = {id(o): nr for nr, o in enumerate(recruitable)}
+        result = dict()
+        for m in self.my_mages():
+            others = [o for o in recruitable if o.name != m.name
+                      and o.paths != m.paths and dominates(o, m)]
+            if mode != 'paths':
+                # Equivalent mages would dominate each other, so only the
+                # one recruitable first keeps its spells.
+                others = [o for o in others if id(m) not in position
+                          or position[id(m)] > position[id(o)]
+                          or not dominates(m, o)]
+            result[m] = others
+        self.dominated[mode] = result
+        return result
+
+    def print_spells_by_mage(self, spells, two_columns=True, fmt='reST',
+                             out=None, dominance='paths', extras=False):
+        """fmt - one of RENDERERS
+           out - file to write to, stdout by default
+           dominance, extras - see Nation.spells_by_mage"""
+        self.print_by_mage(self.spells_by_mage(spells, dominance, extras),
+                           out, fmt)
+
+    def print_by_mage(self, by_mage, out=None, fmt='reST'):
+        """by_mage - result of spells_by_mage"""
+        out = sys.stdout if out is None else out
+        out.write(RENDERERS[fmt]().mages(by_mage))
+
+    def spells_by_mage(self, spells, dominance='paths', extras=False):
+        """dominance - see Nation.dominance
+           extras - also list spells unlocked by booster items (as extra
+                    variants) and by summoned mages (after my_mages, without
+                    the spells of my_mages)"""
         result = [] # [(m, by_variant, includes), (...)]
         my_mages = self.my_mages()
+        matrix = self.castability(spells)
+        dominated = self.dominance(spells, dominance)
+        boosters = self.boosters(spells) if extras else ()
         for m in my_mages:
-            others =  [o for o in self.recruitable_mages()
-                    if o.name != m.name and self.first_in_second(o, m)]
+            others = dominated[m]
             includes = [o.name for o in others] # For message
-            redundant = set()
+            redundant = 0
             for o in others:
-                redundant = redundant.union(o.possible_spells(spells))
-            by_variant = m.spells_by_variant(spells, ignored=redundant)
+                redundant |= matrix.mage_mask(o)
+            by_variant = m.spells_by_variant(matrix, ignored=redundant,
+                                             boosters=boosters)
             result.append((m, by_variant, includes))
+        if extras:
+            own = 0
+            for m in my_mages:
+                own |= matrix.mage_mask(m)
+            includes = list(dict.fromkeys(m.name for m in my_mages))
+            for m in self.summoned_mages():
+                by_variant = m.spells_by_variant(matrix, ignored=own,
+                                                 boosters=boosters)
+                result.append((m, by_variant, includes))
         return result
 
 
+class SpellIndex:
+    """Which mages of which nations can cast a spell, for all nations at once.
+
+    Spells are grouped by their requirement signature (see
+    records.requirement). The mages able to cast a signature, with their
+    chance_to_cast, are found once per group and shared by its spells."""
+    MAGE_LISTS = ('fort_mages', 'cap_mages', 'uw_mages', 'hero_mages')
+
+    def __init__(self, data):
+        self.nations = list(data['nations'])
+        self.spells = dict() # hash ---> spell
+        self.access = dict() # hash ---> nation numbers, None if all nations
+        self.by_signature = dict() # requirement ---> hashes
+        self.recruiters = dict() # mage id ---> nation numbers
+        for nr, ndata in enumerate(self.nations):
+            for word in self.MAGE_LISTS:
+                for mage_id in ndata[word]:
+                    nations = self.recruiters.setdefault(mage_id, [])
+                    if nr not in nations:
+                        nations.append(nr)
+            for spell in ndata['nspells']:
+                self.add_spell(spell, nr)
+        for spell in data['spells'] + data['items']:
+            self.add_spell(spell, None)
+
+        self.mages = dict()
+        by_paths = dict() # Mages sharing paths share variants
+        for mage_id in self.recruiters:
+            md = data['mages'][mage_id]
+            self.mages[mage_id] = Mage(md.paths, md.name, md.gcost)
+            by_paths.setdefault(md.paths, []).append(mage_id)
+        self.casters = dict() # requirement ---> [(mage id, chance), ...]
+        for req in self.by_signature:
+            casters = []
+            for paths, mage_ids in by_paths.items():
+                mage = self.mages[mage_ids[0]]
+                weight = 0
+                for var in mage.variants:
+                    if covers(var.levels, req):
+                        weight += var.weight
+                if weight:
+                    chance = Frac(weight, mage.denominator)
+                    casters.extend((mage_id, chance) for mage_id in mage_ids)
+            casters.sort(key=itemgetter(1), reverse=True)
+            self.casters[req] = casters
+
+    def add_spell(self, spell, nation_nr):
+        spell_hash = spell.hash
+        if spell_hash not in self.spells:
+            self.spells[spell_hash] = spell
+            self.by_signature.setdefault(spell.req, []).append(spell_hash)
+            self.access[spell_hash] = [] if nation_nr is not None else None
+        if nation_nr is not None and self.access[spell_hash] is not None:
+            self.access[spell_hash].append(nation_nr)
+
+    def find(self, name):
+        """Hashes of spells and items called 'name', or the hash itself"""
+        if name in self.spells:
+            return [name]
+        return [h for h, sp in self.spells.items() if sp.name == name]
+
+    def who_can_cast(self, spell_hash):
+        """Returns [(nation data, Mage, chance_to_cast), ...] ordered by
+        nation, then by falling chance"""
+        allowed = self.access[spell_hash]
+        if allowed is not None:
+            allowed = set(allowed)
+        result = []
+        req = self.spells[spell_hash].req
+        for mage_id, chance in self.casters[req]:
+            for nr in self.recruiters[mage_id]:
+                if allowed is None or nr in allowed:
+                    result.append((nr, mage_id, chance))
+        result.sort(key=itemgetter(0)) # Stable, chances stay sorted
+        return [(self.nations[nr], self.mages[mage_id], chance)
+                for nr, mage_id, chance in result]
+
+
+class ReSTRenderer:
+    """Report as a reST document, one section per nation.
+
+    Renderers turn results of Nation.spells_by_mage into text. Each part of
+    the report is built in memory and returned as a single string; the
+    separator goes between nations."""
+    separator = ''
+
+    def begin(self):
+        return '.. contents::\n\n'
 
-mages = {int(k): v for k, v in data['mages'].items()} # no int keys in jascript
-print('.. contents::')
-print()
-for ndata in data['nations']:
-    nation = Nation(ndata, mages)
-    nat = str(nation)
-    print(nat)
-    print('#' * len(nat))
-    if nation.nsmages:
-        print('NSMAGES!')
-    for nsmage in nation.nsmages:
-        print(nsmage['name'], nsmage['paths'])
+    def end(self):
+        return ''
+
+    def nation(self, nation, by_mage):
+        nat = str(nation)
+        lines = [nat, '#' * len(nat)]
+        if nation.nsmages:
+            lines.append('NSMAGES!')
+        for nsmage in nation.nsmages:
+            lines.append('{0} {1}'.format(nsmage.name, nsmage.paths))
+        return '\n'.join(lines) + '\n' + self.mages(by_mage)
+
+    def mages(self, by_mage):
+        lines = []
+        for mage, by_variant, includes in by_mage:
+            m = str(mage)
+            lines.extend((m, '=' * len(m)))
+            if includes:
+                includes = ', '.join(includes)
+                includes = ' and'.join(includes.rsplit(',', 1))
+                lines.append('Omitting spells from {0}.'.format(includes))
+            lines.append('')
+            for var, sps in by_variant:
+                lines.append('Variant {0} {1}:'.format(human(var.paths),
+                                                       var.meta))
+                if sps:
+                    lines.extend(self.table(sps))
+                lines.append('')
+        return ''.join(line + '\n' for line in lines)
+
+    def table(self, spells):
+        """Battle spells on the left, rituals and forgings on the right"""
+        left, right = spell_columns(spells)
+        left = [spell_words(sp) for sp in left]
+        right = [spell_words(sp) for sp in right]
+        widths = column_widths(left or right) + column_widths(right or left)
+        fill = ['\\'] * (len(widths) // 2)
+        border = '  ' + ' '.join('=' * width for width in widths)
+        line = '  ' + ' '.join('%-{0}s'.format(width) for width in widths)
+        lines = [border]
+        lines.extend(line % tuple(words[0] + words[1])
+                     for words in zip_longest(left, right, fillvalue=fill))
+        lines.append(border)
+        return lines
+
+
+SPELL_FIELDS = ('hash', 'name', 'path1', 'path2', 'gems', 'level', 'boosts',
+                'mode')
+
+class JSONRenderer:
+    """Report as a JSON list with one object per nation, one line each"""
+    separator = ',\n'
+
+    def begin(self):
+        return '[\n'
+
+    def end(self):
+        return '\n]\n'
+
+    def nation(self, nation, by_mage):
+        record = {'nation': str(nation), 'name': nation.name,
+                  'epithet': nation.epithet,
+                  'summoned_mages': [{'name': ns.name, 'paths': ns.paths}
+                                     for ns in nation.nsmages],
+                  'mages': self.records(by_mage)}
+        return json.dumps(record, sort_keys=True)
+
+    def mages(self, by_mage):
+        return json.dumps(self.records(by_mage), sort_keys=True) + '\n'
+
+    def records(self, by_mage):
+        result = []
+        for mage, by_variant, includes in by_mage:
+            variants = [{'paths': var.paths, 'chance': str(var.chance),
+                         'meta': var.meta,
+                         'spells': [{field: getattr(sp, field)
+                                     for field in SPELL_FIELDS} for sp in sps]}
+                        for var, sps in by_variant]
+            result.append({'name': mage.name, 'paths': mage.paths,
+                           'gcost': mage.gcost, 'omitting': includes,
+                           'variants': variants})
+        return result
+
+
+class CSVRenderer:
+    """Report as a CSV table with one row per castable spell of a variant"""
+    HEADER = ('nation', 'mage', 'mage_paths', 'gcost', 'variant', 'chance')
+    separator = ''
+
+    def begin(self):
+        return self.rows([self.HEADER + SPELL_FIELDS])
+
+    def end(self):
+        return ''
+
+    def nation(self, nation, by_mage):
+        return self.rows(self.records(str(nation), by_mage))
+
+    def mages(self, by_mage):
+        return self.rows(self.records('', by_mage))
+
+    def records(self, nat, by_mage):
+        for mage, by_variant, includes in by_mage:
+            for var, sps in by_variant:
+                for sp in sps:
+                    yield ((nat, mage.name, mage.paths, mage.gcost,
+                            var.paths, str(var.chance)) +
+                           tuple(getattr(sp, field) for field in SPELL_FIELDS))
+
+    def rows(self, rows):
+        out = io.StringIO()
+        csv.writer(out, lineterminator='\n').writerows(rows)
+        return out.getvalue()
+
+
+RENDERERS = {'reST': ReSTRenderer, 'json': JSONRenderer, 'csv': CSVRenderer}
+
+
+def default_datafile():
+    """gamedata.bin if it's at least as new as gamedata.json"""
+    try:
+        if os.path.getmtime('gamedata.bin') >= os.path.getmtime(
+                'gamedata.json'):
+            return 'gamedata.bin'
+    except OSError:
+        pass
+    return 'gamedata.json'
+
+def load_gamedata(filename='gamedata.json', interner=None):
+    """Reads game data and points the variant cache at the matching file.
+    Spells, items and mages are records (see records.py), nations are dicts.
+    Files ending with .bin (see gamedata_bin.py) are mapped, not parsed;
+    their records are decoded when first used.
+    interner - a records.Interner shared with other loaded files, which
+               then must not be modified; see Datasets"""
+    make = interner.record if interner else from_fields
+    if filename.endswith('.bin'):
+        packed = gamedata_bin.PackedGameData(filename, make)
+        variant_cache.attach(filename, packed.buffer)
+        return packed.as_dict()
+    with open(filename, 'rb') as datafile:
+        raw_data = datafile.read()
+    data = json.loads(raw_data.decode('utf-8'))
+    data['spells'] = [make(Spell, sp) for sp in data['spells']]
+    data['items'] = [make(Item, it) for it in data['items']]
+    for ndata in data['nations']:
+        ndata['nspells'] = [make(Spell, sp) for sp in ndata['nspells']]
+    # no int keys in jascript
+    data['mages'] = {int(k): make(MageData, v)
+                     for k, v in data['mages'].items()}
+    if interner:
+        for key in ('spells', 'items', 'mages'):
+            data[key] = interner.container(data[key])
+        for nr, ndata in enumerate(data['nations']):
+            ndata['nspells'] = interner.container(ndata['nspells'])
+            data['nations'][nr] = interner.container(ndata)
+        data['nations'] = interner.container(data['nations'])
+    variant_cache.attach(filename, raw_data)
+    return data
+
+
+class Datasets:
+    """Game data files loaded side by side, like those of Dominions 3 and 4
+    or of mods, each under a name. Equal records, strings and lists are
+    shared between them, so each file after the first takes about as much
+    memory as its differences. Variants are shared anyway, through
+    variant_cache."""
+    def __init__(self):
+        self.interner = Interner()
+        self.data = dict() # name ---> game data, in load order
+
+    def load(self, name, filename):
+        self.data[name] = load_gamedata(filename, self.interner)
+        return self.data[name]
+
+    def __getitem__(self, name):
+        return self.data[name]
+
+    def __contains__(self, name):
+        return name in self.data
+
+    def names(self):
+        return list(self.data)
+
+def find_nation(data, name):
+    """Nation's data by name, like 'Arcoscephale', or 'Ulm: Enigma of Steel'"""
+    for ndata in data['nations']:
+        if name in (ndata['name'], '{0}: {1}'.format(ndata['name'],
+                                                     ndata['epithet'])):
+            return ndata
+    raise KeyError(name)
+
+def profile_report(data, nations=None, dominance='paths', pstats_file=None):
+    """Analyses nations like render_report, without rendering them.
+    Returns measurements as a dict, ready for json.dump:
+    wall time per nation, counters of hot path events and cache hit rates.
+    pstats_file - if given, cProfile data of the analysis is written there"""
+    if nations is None:
+        nations = data['nations']
+    profiler = cProfile.Profile() if pstats_file else None
+    stats.clear()
+    timings = []
+    for ndata in nations:
+        start = time.perf_counter()
+        if profiler:
+            profiler.enable()
+        nation = Nation(ndata, data['mages'])
+        spells = data['spells'] + nation.nspells + data['items']
+        nation.spells_by_mage(spells, dominance)
+        if profiler:
+            profiler.disable()
+        timings.append({'nation': str(nation),
+                        'seconds': time.perf_counter() - start})
+    if profiler:
+        profiler.dump_stats(pstats_file)
+    hit_rates = dict()
+    for cache in ('variant_cache', 'matrix_row'):
+        looked_up = stats[cache + '_hits'] + stats[cache + '_misses']
+        if looked_up:
+            hit_rates[cache] = stats[cache + '_hits'] / looked_up
+    return {'nations': timings,
+            'seconds': sum(t['seconds'] for t in timings),
+            'counters': {name: stats[name] for name in STATS},
+            'hit_rates': hit_rates}
+
+def render_casters(index, name):
+    """Returns who can cast spells or items called 'name' (or with that hash)
+    index - SpellIndex"""
+    out = io.StringIO()
+    for spell_hash in index.find(name):
+        spell = index.spells[spell_hash]
+        print('{0} ({1}) {2}:'.format(spell.name, spell_hash, spell.paths),
+              file=out)
+        for ndata, mage, chance in index.who_can_cast(spell_hash):
+            print('  {0}: {1} - {2} ({3} chance)'.format(
+                ndata['name'], ndata['epithet'], mage, chance), file=out)
+    return out.getvalue()
+
+def coverage_matrix(data, nations=None):
+    """Likeliest recruitable caster of every spell and item, for every
+    nation, in one pass. Returns (spells, rows) where rows are
+    [(nation data, {hash: (chance_to_cast, Mage)}), ...]; spells nobody
+    can cast, or restricted to other nations, are left out of a row.
+    Mages recruited by several nations, or sharing paths, are analysed once.
+    nations - data of the nations to include, all by default"""
+    if nations is None:
+        nations = data['nations']
+    spells = list(data['spells'])
+    for ndata in data['nations']:
+        spells.extend(ndata['nspells'])
+    spells.extend(data['items'])
+    spells = list({sp.hash: sp for sp in spells}.values())
+    matrix = CastabilityMatrix(spells)
+    shared = matrix.mask_of(sp.hash for sp in data['spells'] + data['items'])
+    mages = dict() # mage id ---> Mage
+    chances = dict() # mage paths ---> {column: chance_to_cast}
+    rows = []
+    for ndata in nations:
+        allowed = shared | matrix.mask_of(sp.hash for sp in ndata['nspells'])
+        best = dict()
+        for word in ('fort_mages', 'cap_mages', 'uw_mages'):
+            for mage_id in ndata[word]:
+                if mage_id not in mages:
+                    md = data['mages'][mage_id]
+                    mages[mage_id] = Mage(md.paths, md.name, md.gcost)
+                mage = mages[mage_id]
+                if mage.paths not in chances:
+                    chances[mage.paths] = {
+                        nr: Frac(weight, mage.denominator)
+                        for nr, weight in matrix.chances(mage).items()}
+                for nr, chance in chances[mage.paths].items():
+                    if not allowed >> nr & 1:
+                        continue
+                    # The likeliest caster, the cheapest of equally likely
+                    if nr not in best or (chance, -mage.gcost) > (
+                            best[nr][0], -best[nr][1].gcost):
+                        best[nr] = (chance, mage)
+        rows.append((ndata, {matrix.spells[nr].hash: cell
+                             for nr, cell in best.items()}))
+    return spells, rows
+
+def render_coverage(data, nations=None):
+    """coverage_matrix as CSV, one row per castable spell of a nation.
+    chance is a float for spreadsheets, exact is the same as a fraction."""
+    spells, rows = coverage_matrix(data, nations)
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(('nation', 'hash', 'spell', 'paths', 'mage', 'gcost',
+                     'chance', 'exact'))
+    for ndata, cells in rows:
+        nat = '{0}: {1}'.format(ndata['name'], ndata['epithet'])
+        for sp in spells:
+            if sp.hash in cells:
+                chance, mage = cells[sp.hash]
+                writer.writerow((nat, sp.hash, sp.name, sp.paths, mage.name,
+                                 mage.gcost, float(chance), chance))
+    return out.getvalue()
+
+def changed_spells(old, new):
+    """Spells and items (not national spells) added, removed or changed
+    between two versions of the game data, both versions of each"""
+    before = {sp.hash: sp for sp in old['spells'] + old['items']}
+    after = {sp.hash: sp for sp in new['spells'] + new['items']}
+    result = []
+    for h in set(before) | set(after):
+        if before.get(h) is not after.get(h) and before.get(h) != after.get(h):
+            result.extend(sp for sp in (before.get(h), after.get(h)) if sp)
+    return result
+
+def affected_nations(old, new):
+    """Nations whose spells_by_mage may differ between two versions of the
+    game data, as [(old nation data, new nation data), ...], with None for
+    a nation missing from one version. A nation is affected if its mages or
+    national spells changed, or if one of its mages might cast a spell or
+    item that changed. Only mages are analysed, not the whole report."""
+    reqs = {sp.req for sp in changed_spells(old, new)}
+    reaches = dict() # mage paths ---> might cast a changed spell
+    def reach(md):
+        if md.paths not in reaches:
+            mage = Mage(md.paths, md.name, md.gcost)
+            reaches[md.paths] = any(covers(var.levels, req) for req in reqs
+                                    for var in mage.variants)
+        return reaches[md.paths]
+    before = dict()
+    for ndata in old['nations']:
+        before.setdefault('{0}: {1}'.format(ndata['name'], ndata['epithet']),
+                          ndata)
+    result = []
+    for ndata in new['nations']:
+        odata = before.pop('{0}: {1}'.format(ndata['name'], ndata['epithet']),
+                           None)
+        if odata is None:
+            result.append((None, ndata))
+            continue
+        # Compared as records, so renumbered mages don't count as changes
+        mages = [[new['mages'][m] for m in ndata[word]]
+                 for word in SpellIndex.MAGE_LISTS]
+        if (mages != [[old['mages'][m] for m in odata[word]]
+                      for word in SpellIndex.MAGE_LISTS] or
+                ndata['nspells'] != odata['nspells'] or
+                any(reach(md) for word in mages for md in word)):
+            result.append((odata, ndata))
+    result.extend((odata, None) for odata in before.values())
+    return result
+
+def _listed_spells(data, ndata, dominance):
+    """{mage key: (Mage, {variant paths: (Variant, {hash: spell})})} of
+    spells_by_mage; a mage listed twice gets two keys"""
+    result = dict()
+    if ndata is None:
+        return result
+    nation = Nation(ndata, data['mages'])
+    spells = data['spells'] + nation.nspells + data['items']
+    listed = Counter()
+    for mage, by_variant, includes in nation.spells_by_mage(spells,
+                                                            dominance):
+        listed[mage.name, mage.paths] += 1
+        key = (mage.name, mage.paths, listed[mage.name, mage.paths])
+        result[key] = (mage, {var.paths: (var, {sp.hash: sp for sp in sps})
+                              for var, sps in by_variant})
+    return result
+
+def nation_changes(old, new, odata, ndata, dominance='paths'):
+    """Spells gained and lost by the variants of a nation's mages between
+    two versions of the game data, as listed by spells_by_mage. Returns
+    [(Mage, Variant, [gained spells], [lost spells]), ...] of the variants
+    that changed. Mages and variants missing from one version have no
+    spells there.
+    odata, ndata - the nation in old and in new, one of them may be None"""
+    before = _listed_spells(old, odata, dominance)
+    after = _listed_spells(new, ndata, dominance)
+    result = []
+    for key in list(after) + [key for key in before if key not in after]:
+        mage = (after.get(key) or before[key])[0]
+        was = before.get(key, (mage, {}))[1]
+        now = after.get(key, (mage, {}))[1]
+        for paths in list(now) + [paths for paths in was if paths not in now]:
+            var = (now.get(paths) or was[paths])[0]
+            was_castable = was.get(paths, (var, {}))[1]
+            castable = now.get(paths, (var, {}))[1]
+            gained = [sp for h, sp in castable.items() if h not in was_castable]
+            lost = [sp for h, sp in was_castable.items() if h not in castable]
+            if gained or lost:
+                result.append((mage, var, gained, lost))
+    return result
+
+def render_diff(old, new, names=None, dominance='paths'):
+    """Change report between two versions of the game data: spells gained
+    (+) and lost (-) by each mage variant, for the nations whose report
+    changed. Only affected_nations are analysed.
+    names - only nations with these names, like in find_nation"""
+    lines = []
+    for odata, ndata in affected_nations(old, new):
+        nat = '{0}: {1}'.format((ndata or odata)['name'],
+                                (ndata or odata)['epithet'])
+        if names and not any(name in (nat, (ndata or odata)['name'])
+                             for name in names):
+            continue
+        if odata is None or ndata is None:
+            lines.append('{0} ({1})'.format(nat, 'added' if odata is None
+                                            else 'removed'))
+            continue
+        changes = nation_changes(old, new, odata, ndata, dominance)
+        if changes:
+            lines.append(nat)
+        shown = None
+        for mage, var, gained, lost in changes:
+            if mage is not shown:
+                lines.append('  {0}'.format(mage))
+                shown = mage
+            lines.append('    Variant {0} {1}:'.format(human(var.paths),
+                                                       var.meta))
+            lines.extend('      + {0} ({1}) {2}'.format(sp.name, sp.hash,
+                                                        sp.paths)
+                         for sp in gained)
+            lines.extend('      - {0} ({1}) {2}'.format(sp.name, sp.hash,
+                                                        sp.paths)
+                         for sp in lost)
+    return ''.join(line + '\n' for line in lines)
+
+def render_nation(data, ndata, dominance='paths', fmt='reST', extras=False):
+    """Returns the section of a single nation
+    dominance, extras - see Nation.spells_by_mage
+    fmt - one of RENDERERS"""
+    nation = Nation(ndata, data['mages'])
     spells = data['spells'] + nation.nspells + data['items']
+    by_mage = nation.spells_by_mage(spells, dominance, extras)
+    return RENDERERS[fmt]().nation(nation, by_mage)
+
+_worker_data = None
+
+def _init_worker(data, datafile):
+    """data is inherited when workers are forked, loaded from datafile
+    otherwise"""
+    global _worker_data
+    _worker_data = data if data is not None else load_gamedata(datafile)
+
+def _render_nation_nr(nr, dominance, fmt, extras):
+    return render_nation(_worker_data, _worker_data['nations'][nr], dominance,
+                         fmt, extras)
+
+def render_report(data, nations=None, jobs=1, datafile=None,
+                  dominance='paths', fmt='reST', extras=False):
+    """Yields the document piece by piece: the header, then one section per
+    nation (with separators if the format needs them), then the footer.
+    nations - data of the nations to include, all by default
+    jobs - number of processes rendering nations, in order regardless
+    datafile - data file for workers that can't be forked
+    dominance, extras - see Nation.spells_by_mage
+    fmt - one of RENDERERS"""
+    if nations is None:
+        nations = data['nations']
+    renderer = RENDERERS[fmt]()
+    yield renderer.begin()
+    if jobs <= 1:
+        sections = (render_nation(data, ndata, dominance, fmt, extras)
+                    for ndata in nations)
+    else:
+        sections = _render_in_pool(data, nations, jobs, datafile,
+                                   partial(_render_nation_nr,
+                                           dominance=dominance, fmt=fmt,
+                                           extras=extras))
+    for nr, section in enumerate(sections):
+        if nr and renderer.separator:
+            yield renderer.separator
+        yield section
+    yield renderer.end()
+
+def _render_in_pool(data, nations, jobs, datafile, render):
+    positions = {id(ndata): nr for nr, ndata in enumerate(data['nations'])}
+    positions = [positions[id(ndata)] for ndata in nations]
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+        initargs = (data, None) # Shared copy-on-write, not pickled
+    else:
+        context = multiprocessing.get_context()
+        initargs = (None, datafile)
+    with context.Pool(jobs, _init_worker, initargs) as pool:
+        yield from pool.imap(render, positions)
 
-    nation.print_spells_by_mage(spells)
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Lists spells castable by mages of Dominions nations.')
+    parser.add_argument('nations', nargs='*',
+                        help="only these nations, like 'Ulm'")
+    parser.add_argument('--data', default=default_datafile(),
+                        help='gamedata.json or gamedata.bin')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='render nations in this many processes')
+    parser.add_argument('--dominance', choices=('paths', 'chance'),
+                        default='paths',
+                        help="omit a mage's spells from mages whose path "
+                        "tokens include its own (paths), or who are never "
+                        "less likely to cast any spell (chance)")
+    parser.add_argument('--extras', action='store_true',
+                        help='also list spells unlocked by booster items and '
+                        'by summoned mages')
+    parser.add_argument('--format', choices=sorted(RENDERERS),
+                        default='reST', help='format of the report')
+    parser.add_argument('--who-casts', metavar='SPELL', action='append',
+                        help='list mages able to cast a spell or forge an '
+                        "item, given by name or hash like 's123'")
+    parser.add_argument('--coverage', action='store_true',
+                        help='print the likeliest recruitable caster of '
+                        'every spell for every nation, as CSV')
+    parser.add_argument('--diff', metavar='OLD',
+                        help='print the spells each mage variant gained or '
+                        'lost since the older data file OLD, analysing only '
+                        'nations the changes may affect')
+    parser.add_argument('--profile', action='store_true',
+                        help='print measurements of the analysis as JSON '
+                        'instead of the report')
+    parser.add_argument('--pstats', metavar='FILE',
+                        help='also write cProfile data of the analysis to '
+                        'FILE; implies --profile')
+    args = parser.parse_args()
+    if args.diff:
+        datasets = Datasets() # Unchanged records are shared and compared fast
+        old = datasets.load('old', args.diff)
+        data = datasets.load('new', args.data)
+        sys.stdout.write(render_diff(old, data, args.nations, args.dominance))
+        variant_cache.save()
+        sys.exit()
+    data = load_gamedata(args.data)
+    try:
+        nations = [find_nation(data, name) for name in args.nations] or None
+    except KeyError as err:
+        parser.error('No such nation: {0}'.format(err))
+    if args.profile or args.pstats:
+        json.dump(profile_report(data, nations, args.dominance, args.pstats),
+                  sys.stdout, sort_keys=True, indent=4)
+        print()
+        variant_cache.save()
+        sys.exit()
+    if args.coverage:
+        sys.stdout.write(render_coverage(data, nations))
+        variant_cache.save()
+        sys.exit()
+    if args.who_casts:
+        index = SpellIndex(data)
+        for name in args.who_casts:
+            if not index.find(name):
+                parser.error('No such spell or item: {0!r}'.format(name))
+        for name in args.who_casts:
+            sys.stdout.write(render_casters(index, name))
+        variant_cache.save()
+        sys.exit()
+    for section in render_report(data, nations, args.jobs, args.data,
+                                 args.dominance, args.format, args.extras):
+        sys.stdout.write(section)
+    variant_cache.save()
@@ -1,7 +1,17 @@
 #! /usr/bin/env python3
 
+import os
+import sys
 import csv
 import json
+import pickle
+import hashlib
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gamedata_bin
 
 MAGIC_PATHS = 'FAWESDNBH' # Sort order, etc
 
@@ -66,207 +76,390 @@ def get_uniques(magic_number):
 """
 """
 
-def read_sites(filename):
+def number(value):
+    """ '12' ---> 12, anything else (like '' or '-1') stays as it is """
+    return int(value) if value.isdigit() else value
+
+def numbered(prefix, last):
+    """ ('com', 3) ---> ['com1', 'com2', 'com3'] """
+    return [prefix + str(n) for n in range(1, last + 1)]
+
+SITE_COLUMNS = dict.fromkeys(['id'] + list(MAGIC_PATHS.strip('H')) +
+                             numbered('com', 4) + numbered('hcom', 4), number)
+MAGE_COLUMNS = dict.fromkeys(['id', 'gcost'] + list(MAGIC_PATHS) +
+                             numbered('rand', 4) + numbered('nbr', 4) +
+                             numbered('link', 4) + numbered('mask', 4), number)
+MAGE_COLUMNS.update(name=str, uniquename=str)
+NATION_COLUMNS = dict.fromkeys(['id', 'era'] + numbered('com', 12) +
+                               numbered('hero', 6) + numbered('uwc', 5) +
+                               numbered('site', 4), number)
+NATION_COLUMNS.update(name=str, epithet=str)
+SPELL_COLUMNS = dict.fromkeys(['id', 'school', 'researchlevel', 'path1',
+                               'pathlevel1', 'path2', 'effect', 'damage',
+                               'fatiguecost'] + numbered('restricted', 7),
+                              number)
+SPELL_COLUMNS.update(name=str)
+ITEM_COLUMNS = dict.fromkeys(['id', 'constlevel', 'mainlevel',
+                              'secondarylevel'] + list(MAGIC_PATHS), number)
+ITEM_COLUMNS.update(name=str, mainpath=str, secondarypath=str)
+
+def read_rows(filename, columns):
+    """ Yields rows of a tab separated file one by one. Only the columns
+    named in 'columns' are kept, each passed through its converter. """
+    with open(filename, 'r') as csvfile:
+        reader = csv.reader(csvfile, delimiter='\t')
+        header = next(reader)
+        wanted = [(header.index(name), name, convert)
+                  for name, convert in columns.items()]
+        for raw in reader:
+            yield {name: convert(raw[nr]) for nr, name, convert in wanted}
+
+
+def iter_sites(filename):
     """ Only used to get capitol only mages """
-    with open(filename, 'r') as sitefile:
-        reader = csv.DictReader(sitefile, delimiter='\t')
-        rows = [row for row in reader]
-        sites = dict()
-        for row in rows:
-            for k, v in row.items():
-                row[k] = int(v) if v.isdigit() else v
-            site_id = row['id']
-            gem_inc = ''
-            for path in MAGIC_PATHS.strip('H'):
-                if row[path]:
-                    gem_inc += path.lower() * row[path]
-            comms = []
-            for n in range(1, 5):
-                comms.append(row['com' + str(n)])
-                comms.append(row['hcom' + str(n)])
-            comms = [comm for comm in comms if comm]
-            sites[site_id] = {'gem_inc': gem_inc, 'comms': comms}
-    return sites
+    for row in read_rows(filename, SITE_COLUMNS):
+        site_id = row['id']
+        gem_inc = ''
+        for path in MAGIC_PATHS.strip('H'):
+            if row[path]:
+                gem_inc += path.lower() * row[path]
+        comms = []
+        for n in range(1, 5):
+            comms.append(row['com' + str(n)])
+            comms.append(row['hcom' + str(n)])
+        comms = [comm for comm in comms if comm]
+        yield site_id, {'gem_inc': gem_inc, 'comms': comms}
+
+def read_sites(filename):
+    return dict(iter_sites(filename))
 
 
+def iter_mages(filename):
+    for row in read_rows(filename, MAGE_COLUMNS):
+        unit_id = row['id']
+        name = row['name'] if not row['uniquename'] else row['uniquename']
+        if '*' in name:
+            name = 'nameless'
+        paths = ''
+        gcost = row['gcost']
+        # TODO: Gift of Reason + Asrapa (hidden magic paths)
+        for path in MAGIC_PATHS:
+            if row[path]:
+                paths += row[path] * path
+        for n in '1234':
+            if row['rand' + n]:
+                chance = str(row['rand' + n])
+                repeats = row['nbr' + n] # A mage with two 50% FW randoms has 2
+                bonus_size = ''
+                if row['link' + n] and row['link' + n] > 1: # Warlock fix
+                    bonus_size = '*' + str(row['link' + n])
+                choice = unmasked(row['mask' + n])
+                token = chance + choice + bonus_size
+                paths += (',' + token) * repeats
+        paths = paths.lstrip(',') # Mages without base paths
+        if not paths:
+            continue # This project explores capabilities of mages ONLY.
+        yield unit_id, {'name': name, 'paths': paths, 'gcost': gcost}
+
 def read_mages(filename):
-    with open(filename, 'r') as unitfile:
-        reader = csv.DictReader(unitfile, delimiter='\t')
-        rows = [row for row in reader]
-        mages = dict()
-        for row in rows:
-            for k, v in row.items():
-                row[k] = int(v) if v.isdigit() else v
-            unit_id = row['id']
-            name = row['name'] if not row['uniquename'] else row['uniquename']
-            if '*' in name:
-                name = 'nameless'
-            paths = ''
-            gcost = row['gcost']
-            # TODO: Gift of Reason + Asrapa (hidden magic paths)
-            for path in MAGIC_PATHS:
-                if row[path]:
-                    paths += row[path] * path
-            for n in '1234':
-                if row['rand' + n]:
-                    chance = str(row['rand' + n])
-                    repeats = row['nbr' + n] # A mage with two 50% FW randoms has 2
-                    bonus_size = ''
-                    if row['link' + n] and row['link' + n] > 1: # Warlock fix
-                        bonus_size = '*' + str(row['link' + n])
-                    choice = unmasked(row['mask' + n])
-                    token = chance + choice + bonus_size
-                    paths += (',' + token) * repeats
-            paths = paths.lstrip(',') # Mages without base paths
-            if not paths:
-                continue # This project explores capabilities of mages ONLY.
-            mages[unit_id] = {'name': name, 'paths': paths, 'gcost': gcost}
-    return mages 
+    return dict(iter_mages(filename))
 
 
-def read_nations(filename, mages, sites):
+def iter_nations(filename, mages, sites):
     """ mages needed to filter spellcasting commanders """
-    with open(filename, 'r') as nationfile:
-        reader = csv.DictReader(nationfile, delimiter='\t')
-        rows = [row for row in reader]
-        nations = dict()
-        for row in rows:
-            for k, v in row.items():
-                row[k] = int(v) if v.isdigit() else v
-            nation_id = row['id']
-            name = row['name']
-            epithet = row['epithet']
-            era = row['era']
-
-            comm_fields = ['com' + str(n) for n in range(1, 13)]
-            fort_mages = [row[comm] for comm in comm_fields]
-            fort_mages = [m for m in fort_mages if m in mages]
-
-            hero_fields = ['hero' + str(n) for n in range(1, 7)]
-            hero_mages = [row[hero] for hero in hero_fields]
-            hero_mages = [h for h in hero_mages if h in mages]
-
-            uw_fields = ['uwc' + str(n) for n in range(1, 6)]
-            uw_mages = [row[uwc] for uwc in uw_fields]
-            uw_mages = [uw for uw in uw_mages if uw in mages]
-
-            gem_inc = ''
-            cap_mages = []
-            cap_sites = [row['site' + str(n)] for n in range(1, 5)]
-            cap_sites = [sites[c] for c in cap_sites if c]
-            for s in cap_sites:
-                cap_mages.extend(s['comms'])
-                gem_inc += s['gem_inc']
-            cap_mages = [comm for comm in cap_mages if comm in mages]
-            gem_inc = ''.join(sorted(gem_inc))
-
-            nations[nation_id] = {'name': name, 'epithet': epithet, 'era': era,
-                    'fort_mages': fort_mages, 'hero_mages': hero_mages,
-                    'cap_mages': cap_mages, 'uw_mages': uw_mages,
-                    'gem_inc': gem_inc}
-    return nations
+    for row in read_rows(filename, NATION_COLUMNS):
+        nation_id = row['id']
+        name = row['name']
+        epithet = row['epithet']
+        era = row['era']
 
-def read_spells(filename, mages):
+        fort_mages = [row[comm] for comm in numbered('com', 12)]
+        fort_mages = [m for m in fort_mages if m in mages]
+
+        hero_mages = [row[hero] for hero in numbered('hero', 6)]
+        hero_mages = [h for h in hero_mages if h in mages]
+
+        uw_mages = [row[uwc] for uwc in numbered('uwc', 5)]
+        uw_mages = [uw for uw in uw_mages if uw in mages]
+
+        gem_inc = ''
+        cap_mages = []
+        cap_sites = [row[site] for site in numbered('site', 4)]
+        cap_sites = [sites[c] for c in cap_sites if c]
+        for s in cap_sites:
+            cap_mages.extend(s['comms'])
+            gem_inc += s['gem_inc']
+        cap_mages = [comm for comm in cap_mages if comm in mages]
+        gem_inc = ''.join(sorted(gem_inc))
+
+        yield nation_id, {'name': name, 'epithet': epithet, 'era': era,
+                'fort_mages': fort_mages, 'hero_mages': hero_mages,
+                'cap_mages': cap_mages, 'uw_mages': uw_mages,
+                'gem_inc': gem_inc}
+
+def read_nations(filename, mages, sites):
+    return dict(iter_nations(filename, mages, sites))
+
+
+def iter_spells(filename, mages):
     """ Mages argument used to mark spells summoning mages """
-    with open('Spells.csv', 'r') as spellfile:
-        reader = csv.DictReader(spellfile, delimiter='\t')
-        rows = [row for row in reader if row['school'] != '255']
-        spells = []
-        for row in rows:
-            for k, v in row.items():
-                row[k] = int(v) if v.isdigit() else v
-            name = row['name']
-            path1 = path_legend[row['path1']] * row['pathlevel1']
-            path2 = '' if row['path2'] == 255 else path_legend[row['path2']]
-            nation_fields = ['restricted' + str(n) for n in range(1, 8)]
-            nations = [row[nation] for nation in nation_fields if row[nation]]
-            # Summoned normal, unique commander mages  expand magic versatility:
-
-            sumages = []
-            if row['effect'] in (10021, 10093):
-                sumages = [row['damage']]
-            elif row['effect'] == 10089:
-                sumages = get_uniques(row['damage'])
-            elif row['effect'] == 10100:
-                if row['damage'] == 1: # Hidden in Snow
-                    sumages = [1200] # Unfrozen Mage
-                elif row['damage'] == 2: # Hidden in Sand
-                    sumages = [1978] # Dust Priest
-            elif row['effect'] == 10076: # Tartarian Gate
-                sumages = [771, 772, 773, 774, 775, 776, 777]
-
-            sumages = [sm for sm in sumages if sm in mages]
-            boosts = '/'.join(mages[sm]['paths'] for sm in sumages)
-            boosts = '>' + boosts if sumages else boosts
-
-            mode = 'battle' if row['effect'] < 10000 else 'ritual'
-            hash_id = 's' + str(row['id'])
-            level = school_legend[row['school']] + str(row['researchlevel'])
-            gems = ''
-            if row['fatiguecost'] >= 100:
-                gems = int(row['fatiguecost']) // 100
-                gems = str(gems) + path1[0].lower()
-            spells.append({'name': name, 'path1': path1, 'path2': path2,
-                'level': level, 'nations': nations, 'sumages': sumages,
-                'mode': mode, 'hash': hash_id, 'gems': gems, 'boosts': boosts})
-    return spells
+    for row in read_rows(filename, SPELL_COLUMNS):
+        if row['school'] == 255:
+            continue
+        name = row['name']
+        path1 = path_legend[row['path1']] * row['pathlevel1']
+        path2 = '' if row['path2'] == 255 else path_legend[row['path2']]
+        nations = [row[nation] for nation in numbered('restricted', 7)
+                   if row[nation]]
+        # Summoned normal, unique commander mages  expand magic versatility:
+
+        sumages = []
+        if row['effect'] in (10021, 10093):
+            sumages = [row['damage']]
+        elif row['effect'] == 10089:
+            sumages = get_uniques(row['damage'])
+        elif row['effect'] == 10100:
+            if row['damage'] == 1: # Hidden in Snow
+                sumages = [1200] # Unfrozen Mage
+            elif row['damage'] == 2: # Hidden in Sand
+                sumages = [1978] # Dust Priest
+        elif row['effect'] == 10076: # Tartarian Gate
+            sumages = [771, 772, 773, 774, 775, 776, 777]
+
+        sumages = [sm for sm in sumages if sm in mages]
+        boosts = '/'.join(mages[sm]['paths'] for sm in sumages)
+        boosts = '>' + boosts if sumages else boosts
+
+        mode = 'battle' if row['effect'] < 10000 else 'ritual'
+        hash_id = 's' + str(row['id'])
+        level = school_legend[row['school']] + str(row['researchlevel'])
+        gems = ''
+        if row['fatiguecost'] >= 100:
+            gems = int(row['fatiguecost']) // 100
+            gems = str(gems) + path1[0].lower()
+        yield {'name': name, 'path1': path1, 'path2': path2,
+            'level': level, 'nations': nations, 'sumages': sumages,
+            'mode': mode, 'hash': hash_id, 'gems': gems, 'boosts': boosts}
+
+def read_spells(filename, mages):
+    return list(iter_spells(filename, mages))
+
+
+def iter_items(filename):
+    for row in read_rows(filename, ITEM_COLUMNS):
+        if row['constlevel'] == 12:
+            continue
+        name = row['name']
+        level = 'Cons' + str(row['constlevel'])
+        path1 = row['mainpath'] * row['mainlevel']
+        path2 = ''
+        hash_id = 'i' + str(row['id'])
+        if row['secondarypath']:
+            path2 = row['secondarypath'] * row['secondarylevel']
+        gems = str(len(path1) * 5) + path1[0].lower()
+        if path2:
+            gems += '+' + str(len(path2) * 5) + path2[0].lower()
+        boosts = ''
+        for path in MAGIC_PATHS:
+            if row[path]:
+                boosts += path * row[path]
+        yield {'name': name, 'level': level, 'path1': path1,
+            'path2': path2, 'boosts': boosts, 'mode': 'forge',
+            'hash': hash_id, 'gems': gems}
 
 def read_items(filename):
-    with open('BaseI.csv', 'r') as itemfile:
-        reader = csv.DictReader(itemfile, delimiter='\t')
-        rows = [row for row in reader if row['constlevel'] != '12']
-        magic_items = []
-        for row in rows:
-            for k, v in row.items():
-                row[k] = int(v) if v.isdigit() else v
-            name = row['name']
-            level = 'Cons' + str(row['constlevel'])
-            path1 = row['mainpath'] * row['mainlevel']
-            path2 = ''
-            hash_id = 'i' + str(row['id'])
-            if row['secondarypath']:
-                path2 = row['secondarypath'] * row['secondarylevel']
-            gems = str(len(path1) * 5) + path1[0].lower()
-            if path2:
-                gems += '+' + str(len(path2) * 5) + path2[0].lower()
-            boosts = ''
-            for path in MAGIC_PATHS:
-                if row[path]:
-                    boosts += path * row[path]
-            magic_items.append({'name': name, 'level': level, 'path1': path1,
-                'path2': path2, 'boosts': boosts, 'mode': 'forge',
-                'hash': hash_id, 'gems': gems})
-
-    return magic_items
-
-
-def prepare_output(nations, spells, mages, magic_items):
-    output = dict()
-    output['mages'] = mages
-    output['nations'] = []
+    return list(iter_items(filename))
+
+
+def without_nations(spell):
+    return {k: v for k, v in spell.items() if k != 'nations'}
+
+def nation_output(nations, spells):
+    """ Nations with their own spells, ready for gamedata.json """
+    result = []
     for nat_id, nat in nations.items():
         if nat_id in (6, 23, 24, 25):
             continue # (reserved), Independents, Special Monsters x2
-        nat['nspells'] = [sp.copy() for sp in spells if nat_id in sp['nations']]
-        for nspell in nat['nspells']:
-            del nspell['nations'] # This is why I'm using .copy() above.
-        output['nations'].append(nat)
+        nspells = [without_nations(sp) for sp in spells
+                   if nat_id in sp['nations']]
+        result.append(dict(nat, nspells=nspells))
+    return result
+
+def spell_output(spells):
+    """ Spells available to every nation """
+    return [without_nations(sp) for sp in spells if not sp['nations']]
+
+def write_json(output, outfile):
+    """ Writes the same text as json.dump(output, outfile, sort_keys=True,
+    indent=4), one record at a time """
+    encoder = json.JSONEncoder(sort_keys=True, indent=4)
+    outfile.write('{')
+    for nr, key in enumerate(sorted(output)):
+        value = output[key]
+        outfile.write(',' if nr else '')
+        outfile.write('\n    ' + encoder.encode(key) + ': ')
+        if isinstance(value, dict):
+            records = [(encoder.encode(str(k)) + ': ', v)
+                       for k, v in sorted(value.items())]
+            brackets = '{}'
+        else:
+            records = [('', v) for v in value]
+            brackets = '[]'
+        outfile.write(brackets[0])
+        for rec_nr, (prefix, record) in enumerate(records):
+            outfile.write(',' if rec_nr else '')
+            text = encoder.encode(record).replace('\n', '\n' + ' ' * 8)
+            outfile.write('\n' + ' ' * 8 + prefix + text)
+        outfile.write('\n    ' + brackets[1] if records else brackets[1])
+    outfile.write('\n}' if output else '}')
+
+# Intermediate tables: (name, source file, tables it needs, reader)
+TABLES = [('sites', 'MagicSites.csv', (), read_sites),
+          ('mages', 'BaseU.csv', (), read_mages),
+          ('nations', 'Nations.csv', ('mages', 'sites'), read_nations),
+          ('spells', 'Spells.csv', ('mages',), read_spells),
+          ('items', 'BaseI.csv', (), read_items)]
+# Joined sections of gamedata.json: (name, tables it needs, join)
+JOINS = [('nations', ('nations', 'spells'), nation_output),
+         ('spells', ('spells',), spell_output)]
+
+def file_hash(filename):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as source:
+        for chunk in iter(lambda: source.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ImportCache:
+    """ Tables built by earlier runs. Each is stored with a key made of the
+    hashes of all source files it was built from, directly or not. """
+    VERSION = 1 # Bump when the layout of tables changes
+
+    def __init__(self, filename, load=True):
+        self.filename = filename
+        self.entries = dict()
+        self.rebuilt = []
+        if not load:
+            return
+        try:
+            with open(filename, 'rb') as cachefile:
+                stored = pickle.load(cachefile)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return
+        if stored.get('version') == self.VERSION:
+            self.entries = stored['entries']
+
+    def get(self, name, key, build):
+        """ Value stored under 'name' if its key is 'key', else build() """
+        if self.has(name, key):
+            return self.entries[name][1]
+        return self.put(name, key, build())
+
+    def has(self, name, key):
+        return name in self.entries and self.entries[name][0] == key
+
+    def put(self, name, key, value):
+        self.entries[name] = (key, value)
+        self.rebuilt.append(name)
+        return value
 
-    output['spells'] = [spell for spell in spells if not spell['nations']]
-    for spell in output['spells']:
-        del spell['nations']
-    output['items'] = magic_items
-    return output
+    def save(self):
+        if not self.rebuilt:
+            return
+        with open(self.filename, 'wb') as cachefile:
+            pickle.dump({'version': self.VERSION, 'entries': self.entries},
+                        cachefile, pickle.HIGHEST_PROTOCOL)
 
-sites = read_sites('MagicSites.csv')
-mages = read_mages('BaseU.csv')
-nations = read_nations('Nations.csv', mages, sites)
-spells = read_spells('Spells.csv', mages)
-magic_items = read_items('BaseU.csv')
-output = prepare_output(nations, spells, mages, magic_items)
 
-with open('../gamedata.json', 'w') as outfile:
-    json.dump(output, outfile, sort_keys=True, indent=4)
+def build_output(cache, directory='.', jobs=1):
+    """ Returns (output, its key), reusing whatever the cache holds.
+    directory - where the CSV files are
+    jobs - processes reading CSV files at the same time """
+    keys, tables = dict(), dict()
+    sources = dict()
+    for name, source, needs, reader in TABLES:
+        sources[name] = os.path.join(directory, source)
+        keys[name] = (file_hash(sources[name]),) + tuple(keys[n]
+                                                         for n in needs)
+    if jobs > 1:
+        tables = read_tables(cache, keys, sources, jobs)
+    for name, source, needs, reader in TABLES:
+        if name not in tables:
+            tables[name] = cache.get(name + ' table', keys[name],
+                    lambda: reader(sources[name], *[tables[n] for n in needs]))
+    output = {'mages': tables['mages'], 'items': tables['items']}
+    for name, needs, join in JOINS:
+        key = tuple(keys[n] for n in needs)
+        output[name] = cache.get(name + ' section', key,
+                lambda: join(*[tables[n] for n in needs]))
+    return output, tuple(keys[name] for name, *rest in TABLES)
 
+def read_tables(cache, keys, sources, jobs):
+    """ Tables of TABLES, those not in the cache read by a process pool.
+    A table is read as soon as the tables it needs are there, so files
+    that don't depend on each other are read at the same time. """
+    tables, waiting = dict(), dict()
+    for name, source, needs, reader in TABLES:
+        if cache.has(name + ' table', keys[name]):
+            tables[name] = cache.get(name + ' table', keys[name], None)
+        else:
+            waiting[name] = (needs, reader)
+    if not waiting:
+        return tables
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+    running = dict() # future ---> table name
+    with ProcessPoolExecutor(min(jobs, len(waiting)), context) as pool:
+        while waiting or running:
+            for name, (needs, reader) in list(waiting.items()):
+                if all(n in tables for n in needs):
+                    future = pool.submit(reader, sources[name],
+                                         *[tables[n] for n in needs])
+                    running[future] = name
+                    del waiting[name]
+            done, unused = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                tables[name] = cache.put(name + ' table', keys[name],
+                                         future.result())
+    return tables
 
+def main():
+    parser = argparse.ArgumentParser(
+        description='Writes ../gamedata.json and ../gamedata.bin from mod '
+        'inspector CSV files. Only tables whose sources changed are rebuilt.')
+    parser.add_argument('--full', action='store_true',
+                        help='ignore tables cached by earlier runs')
+    parser.add_argument('--csv', default='.', metavar='DIR',
+                        help='directory with the CSV files, which also keeps '
+                        'the cache')
+    parser.add_argument('-o', '--output', default='../gamedata.json',
+                        help='JSON file to write; the .bin file goes next to '
+                        'it')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='processes reading CSV files at the same time, '
+                        'one per CPU by default')
+    args = parser.parse_args()
+    cache = ImportCache(os.path.join(args.csv, 'import_cache.pickle'),
+                        load=not args.full)
+    output, key = build_output(cache, args.csv, args.jobs)
+    targets = (args.output, os.path.splitext(args.output)[0] + '.bin')
+    key = (key, targets) # Written elsewhere, written anew
+    written = cache.entries.get('output')
+    if written and written[0] == key and all(os.path.exists(target)
+                                             for target in targets):
+        print('Nothing changed.')
+        return
+    with open(targets[0], 'w') as outfile:
+        write_json(output, outfile)
+    gamedata_bin.dump(output, targets[1])
+    cache.entries['output'] = (key, None)
+    cache.rebuilt.append('output')
+    cache.save()
+    print('Rebuilt:', ', '.join(cache.rebuilt))
 
+if __name__ == '__main__':
+    main()
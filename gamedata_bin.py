@@ -0,0 +1,250 @@
+#! /usr/bin/env python3
+#
+# Compact binary version of gamedata.json, loaded lazily through mmap.
+#
+# Layout (little endian, every number an unsigned 32 bit int):
+#   header   - magic, version, then (offset, count) of every section
+#   strings  - count+1 offsets into the blob that follows them; all text in
+#              the file is stored once here and referenced by index
+#   ints     - pool of ints; lists (like fort_mages) are (start, count) in it
+#   spells   - fixed width records, global spells first, then nation spells;
+#              the count in the header is that of global spells only
+#   items    - like spells, without sumages
+#   mages    - sorted by unit id, so they can be bisected
+#   nations  - nspells are (start, count) in the spells section
+#
+# Usage: ./gamedata_bin.py [gamedata.json [gamedata.bin]]
+#
+import sys
+import json
+import mmap
+import struct
+from bisect import bisect_left
+from collections.abc import Mapping, Sequence
+
+from records import Item, Spell, MageData, from_fields
+
+MAGIC = b'BYGD'
+VERSION = 1
+
+SECTIONS = ('strings', 'ints', 'spells', 'items', 'mages', 'nations')
+HEADER = struct.Struct('<4sI' + 'II' * len(SECTIONS))
+U32 = struct.Struct('<I')
+
+SPELL_TEXT = ('name', 'path1', 'path2', 'level', 'mode', 'hash', 'gems',
+              'boosts')
+SPELL = struct.Struct('<{0}I'.format(len(SPELL_TEXT) + 2)) # + sumages
+ITEM = struct.Struct('<{0}I'.format(len(SPELL_TEXT)))
+MAGE = struct.Struct('<4I') # id, name, paths, gcost
+NATION_LISTS = ('fort_mages', 'cap_mages', 'hero_mages', 'uw_mages')
+NATION = struct.Struct('<4I{0}I'.format(2 * (len(NATION_LISTS) + 1)))
+
+
+class _Writer:
+    def __init__(self):
+        self.strings = dict()
+        self.ints = []
+
+    def text(self, word):
+        if word not in self.strings:
+            self.strings[word] = len(self.strings)
+        return self.strings[word]
+
+    def int_list(self, numbers):
+        start = len(self.ints)
+        self.ints.extend(numbers)
+        return start, len(numbers)
+
+    def spell(self, spell):
+        fields = [self.text(spell[key]) for key in SPELL_TEXT]
+        return SPELL.pack(*(fields + list(self.int_list(spell['sumages']))))
+
+    def item(self, item):
+        return ITEM.pack(*[self.text(item[key]) for key in SPELL_TEXT])
+
+
+def dump(output, filename):
+    """output - game data, as written to (or read from) gamedata.json"""
+    writer = _Writer()
+    spells = [writer.spell(sp) for sp in output['spells']]
+    nations = []
+    for nat in output['nations']:
+        fields = [writer.text(nat['name']), writer.text(nat['epithet']),
+                  nat['era'], writer.text(nat['gem_inc'])]
+        for key in NATION_LISTS:
+            fields.extend(writer.int_list(nat[key]))
+        fields.extend((len(spells), len(nat['nspells'])))
+        spells.extend(writer.spell(sp) for sp in nat['nspells'])
+        nations.append(NATION.pack(*fields))
+    items = [writer.item(it) for it in output['items']]
+    mages = sorted((int(k), v) for k, v in output['mages'].items())
+    mages = [MAGE.pack(k, writer.text(v['name']), writer.text(v['paths']),
+                       v['gcost']) for k, v in mages]
+
+    blobs = [w.encode('utf-8') for w in sorted(writer.strings,
+                                               key=writer.strings.get)]
+    offsets = [0]
+    for blob in blobs:
+        offsets.append(offsets[-1] + len(blob))
+    strings = (struct.pack('<{0}I'.format(len(offsets)), *offsets) +
+               b''.join(blobs))
+    ints = struct.pack('<{0}I'.format(len(writer.ints)), *writer.ints)
+    bodies = [(strings, len(blobs)), (ints, len(writer.ints)),
+              (b''.join(spells), len(output['spells'])),
+              (b''.join(items), len(items)),
+              (b''.join(mages), len(mages)),
+              (b''.join(nations), len(nations))]
+    header = [MAGIC, VERSION]
+    position = HEADER.size
+    for body, count in bodies:
+        header.extend((position, count))
+        position += len(body)
+    with open(filename, 'wb') as outfile:
+        outfile.write(HEADER.pack(*header))
+        for body, count in bodies:
+            outfile.write(body)
+
+
+class Table(Sequence):
+    """Read-only list of records, each decoded on first access"""
+    def __init__(self, decode, start, count):
+        self.decode = decode
+        self.start = start
+        self.count = count
+        self.records = [None] * count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, nr):
+        if isinstance(nr, slice):
+            return [self[n] for n in range(*nr.indices(self.count))]
+        if nr < 0:
+            nr += self.count
+        if not 0 <= nr < self.count:
+            raise IndexError(nr)
+        if self.records[nr] is None:
+            self.records[nr] = self.decode(self.start + nr)
+        return self.records[nr]
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __eq__(self, other):
+        """Equal to lists and tables of equal records, like a list"""
+        if not isinstance(other, (list, Table)):
+            return NotImplemented
+        return len(self) == len(other) and all(
+            mine == theirs for mine, theirs in zip(self, other))
+
+    __hash__ = None
+
+
+class MageTable(Mapping):
+    """unit id ---> mage, decoded on first access"""
+    def __init__(self, packed):
+        self.packed = packed
+        self.ids = [packed.mage_id(nr) for nr in range(packed.counts['mages'])]
+        self.records = dict()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __getitem__(self, unit_id):
+        if unit_id not in self.records:
+            nr = bisect_left(self.ids, unit_id)
+            if nr == len(self.ids) or self.ids[nr] != unit_id:
+                raise KeyError(unit_id)
+            self.records[unit_id] = self.packed.mage(nr)
+        return self.records[unit_id]
+
+
+class PackedGameData:
+    """Game data read from a file written by dump()
+    make - makes records as they are decoded, see records.Interner.record"""
+    def __init__(self, filename, make=from_fields):
+        self.make = make
+        with open(filename, 'rb') as datafile:
+            self.buffer = mmap.mmap(datafile.fileno(), 0,
+                                    access=mmap.ACCESS_READ)
+        header = HEADER.unpack_from(self.buffer)
+        if header[0] != MAGIC or header[1] != VERSION:
+            raise ValueError('{0} is not a version {1} game data file'.format(
+                filename, VERSION))
+        self.offsets = dict(zip(SECTIONS, header[2::2]))
+        self.counts = dict(zip(SECTIONS, header[3::2]))
+        self.blob = self.offsets['strings'] + U32.size * (
+            self.counts['strings'] + 1)
+        self.texts = [None] * self.counts['strings']
+
+    def text(self, nr):
+        if self.texts[nr] is None:
+            start, end = struct.unpack_from(
+                '<2I', self.buffer, self.offsets['strings'] + U32.size * nr)
+            self.texts[nr] = self.buffer[self.blob + start:
+                                         self.blob + end].decode('utf-8')
+        return self.texts[nr]
+
+    def int_list(self, start, count):
+        return list(struct.unpack_from('<{0}I'.format(count), self.buffer,
+                                       self.offsets['ints'] + U32.size * start))
+
+    def spell(self, nr):
+        fields = SPELL.unpack_from(self.buffer,
+                                   self.offsets['spells'] + SPELL.size * nr)
+        spell = {key: self.text(f) for key, f in zip(SPELL_TEXT, fields)}
+        spell['sumages'] = self.int_list(*fields[-2:])
+        return self.make(Spell, spell)
+
+    def item(self, nr):
+        fields = ITEM.unpack_from(self.buffer,
+                                  self.offsets['items'] + ITEM.size * nr)
+        return self.make(Item, {key: self.text(f)
+                                for key, f in zip(SPELL_TEXT, fields)})
+
+    def mage_id(self, nr):
+        return U32.unpack_from(self.buffer,
+                               self.offsets['mages'] + MAGE.size * nr)[0]
+
+    def mage(self, nr):
+        fields = MAGE.unpack_from(self.buffer,
+                                  self.offsets['mages'] + MAGE.size * nr)
+        return self.make(MageData, {'name': self.text(fields[1]),
+                                    'paths': self.text(fields[2]),
+                                    'gcost': fields[3]})
+
+    def nation(self, nr):
+        fields = NATION.unpack_from(self.buffer,
+                                    self.offsets['nations'] + NATION.size * nr)
+        nation = {'name': self.text(fields[0]),
+                  'epithet': self.text(fields[1]), 'era': fields[2],
+                  'gem_inc': self.text(fields[3])}
+        lists = fields[4:]
+        for nr, key in enumerate(NATION_LISTS):
+            nation[key] = self.int_list(*lists[2 * nr:2 * nr + 2])
+        nation['nspells'] = Table(self.spell, *lists[-2:])
+        return nation
+
+    def as_dict(self):
+        """Same keys as gamedata.json, with int mage ids"""
+        return {'spells': Table(self.spell, 0, self.counts['spells']),
+                'items': Table(self.item, 0, self.counts['items']),
+                'mages': MageTable(self),
+                'nations': Table(self.nation, 0, self.counts['nations'])}
+
+
+def load(filename, make=from_fields):
+    return PackedGameData(filename, make).as_dict()
+
+
+if __name__ == '__main__':
+    source = sys.argv[1] if len(sys.argv) > 1 else 'gamedata.json'
+    target = sys.argv[2] if len(sys.argv) > 2 else 'gamedata.bin'
+    with open(source, 'r') as datafile:
+        dump(json.load(datafile), target)
@@ -0,0 +1,227 @@
+#! /usr/bin/env python3
+#
+# Spell planner for one nation:
+# - rituals and forgings ranked by the turns of gem income they need, using
+#   the gems its capital sites give every turn (gem_inc in gamedata.json)
+# - the cheapest set of recruitable mages, by gold, able to cast a list of
+#   spells
+#
+# Usage:
+#   ./planner.py Ulm [--turns 10]
+#   ./planner.py Ulm --cover 'Bind Scorpion Beast' i42 [--min-chance 1/2]
+#
+import sys
+import math
+import argparse
+from collections import Counter
+from fractions import Fraction as Frac
+
+import core
+
+
+def gem_costs(gems):
+    """'5f+5e' ---> {'f': 5, 'e': 5}, '' ---> {}"""
+    costs = Counter()
+    for part in filter(None, gems.split('+')):
+        costs[part[-1]] += int(part[:-1])
+    return costs
+
+def turns_to_pay(costs, income):
+    """Turns of income needed to collect gems for costs; None if one kind
+    is never collected. Every kind is collected at the same time.
+    costs, income - {gem letter: amount}, income per turn"""
+    turns = 0
+    for gem, cost in costs.items():
+        if not income[gem]:
+            return None
+        turns = max(turns, math.ceil(cost / income[gem]))
+    return turns
+
+def cheapest_cover(universe, candidates):
+    """Cheapest subset of candidates whose masks together have every bit
+    of universe, by branch and bound. Returns (cost, [item, ...]), or None
+    if some bit can't be covered.
+    candidates - [(cost, mask, item), ...]"""
+    # A candidate is useless if another covers at least its bits for at
+    # most its cost; only the first of candidates with equal masks stays.
+    ordered = sorted(((cost, mask & universe, nr, item)
+                      for nr, (cost, mask, item) in enumerate(candidates)
+                      if mask & universe),
+                     key=lambda c: (c[0], -bin(c[1]).count('1'), c[2]))
+    useful = []
+    for cost, mask, nr, item in ordered:
+        if not any(mask & ~other == 0 for c, other, n, i in useful):
+            useful.append((cost, mask, nr, item))
+    covering = dict() # bit ---> numbers of useful candidates, cheapest first
+    for nr, (cost, mask, unused, item) in enumerate(useful):
+        for bit in core.set_bits(mask):
+            covering.setdefault(bit, []).append(nr)
+    if any(bit not in covering for bit in core.set_bits(universe)):
+        return None
+    cheapest = {bit: useful[nrs[0]][0] for bit, nrs in covering.items()}
+
+    # Greedy solution first, so that the search starts with a bound
+    best_cost, best = 0, []
+    uncovered = universe
+    while uncovered:
+        nr = min((nr for nr, c in enumerate(useful) if c[1] & uncovered),
+                 key=lambda nr: useful[nr][0] /
+                 bin(useful[nr][1] & uncovered).count('1'))
+        best_cost += useful[nr][0]
+        best.append(nr)
+        uncovered &= ~useful[nr][1]
+
+    def search(uncovered, cost, chosen, banned):
+        nonlocal best_cost, best
+        if not uncovered:
+            if cost < best_cost:
+                best_cost, best = cost, chosen
+            return
+        bits = list(core.set_bits(uncovered))
+        if cost + max(cheapest[bit] for bit in bits) >= best_cost:
+            return
+        # Every cover has one of the candidates of the hardest bit left
+        options = min(([nr for nr in covering[bit] if not banned >> nr & 1]
+                       for bit in bits), key=len)
+        for nr in options:
+            search(uncovered & ~useful[nr][1], cost + useful[nr][0],
+                   chosen + [nr], banned)
+            banned |= 1 << nr # Covers with nr were all searched above
+
+    search(universe, 0, [], 0)
+    best.sort(key=lambda nr: useful[nr][2])
+    return best_cost, [useful[nr][3] for nr in best]
+
+
+class Planner:
+    """Plans of one nation, from gamedata.json data. Mages are its
+    recruitable mages; heroes can't be counted on."""
+    def __init__(self, data, ndata):
+        self.nation = core.Nation(ndata, data['mages'])
+        self.income = Counter(ndata['gem_inc'])
+        self.spells = data['spells'] + self.nation.nspells + data['items']
+        self.matrix = self.nation.castability(self.spells)
+        self.mages = self.nation.recruitable_mages()
+
+    def best_casters(self):
+        """{column: (chance_to_cast, Mage)} of the likeliest recruitable
+        caster of each spell; the cheapest one if chances are equal"""
+        result = dict()
+        for mage in self.mages:
+            for nr, weight in self.matrix.chances(mage).items():
+                chance = Frac(weight, mage.denominator)
+                if nr not in result or chance > result[nr][0]:
+                    result[nr] = (chance, mage)
+        return result
+
+    def rituals(self, turns=None):
+        """Returns [(turns to pay, spell, chance_to_cast, Mage), ...] of
+        castable rituals and forgings, soonest first, then likeliest.
+        turns - leave out those needing more turns of income"""
+        result = []
+        for nr, (chance, mage) in self.best_casters().items():
+            spell = self.matrix.spells[nr]
+            if spell.mode not in ('ritual', 'forge'):
+                continue
+            needed = turns_to_pay(gem_costs(spell.gems), self.income)
+            if needed is None or (turns is not None and needed > turns):
+                continue
+            result.append((needed, spell, chance, mage))
+        result.sort(key=lambda r: (r[0], -r[2], r[1].paths, r[1].name))
+        return result
+
+    def find(self, name):
+        """Spell or item by name or hash, among those of the nation"""
+        for spell in self.spells:
+            if name in (spell.hash, spell.name):
+                return spell
+        raise KeyError(name)
+
+    def cover(self, spells, min_chance=1):
+        """Cheapest recruitable mages, by gold, with a chance_to_cast of at
+        least min_chance for every spell one of them can cast.
+        Returns (gold, [(Mage, [spells it is chosen for]), ...],
+        [spells no mage can cast])"""
+        universe = self.matrix.mask_of(sp.hash for sp in spells)
+        candidates = []
+        for mage in self.mages:
+            mask = 0
+            for nr, weight in self.matrix.chances(mage).items():
+                if Frac(weight, mage.denominator) >= min_chance:
+                    mask |= 1 << nr
+            candidates.append((mage.gcost, mask, mage))
+        reachable = 0
+        for cost, mask, mage in candidates:
+            reachable |= mask
+        missing = [sp for sp in spells if sp.hash not in
+                   self.matrix.hashes_in(universe & reachable)]
+        gold, chosen = cheapest_cover(universe & reachable, candidates)
+        result = []
+        left = universe & reachable
+        for mage in chosen:
+            mask = next(m for c, m, cand in candidates if cand is mage)
+            result.append((mage, self.matrix.spells_in(mask & left)))
+            left &= ~mask
+        return gold, result, missing
+
+
+def render_rituals(planner, turns=None):
+    income = ' '.join('{0}{1}'.format(gem, count) for gem, count
+                      in sorted(planner.income.items()))
+    lines = ['{0} - gems per turn: {1}'.format(planner.nation, income or
+                                                'none'), '']
+    for needed, spell, chance, mage in planner.rituals(turns):
+        lines.append('  {0:>3} turn(s): {1} ({2}) {3} {4} - {5} '
+                     '({6} chance)'.format(needed, spell.name, spell.hash,
+                                           spell.paths, spell.gems or 'free',
+                                           mage, chance))
+    return '\n'.join(lines) + '\n'
+
+def render_cover(planner, spells, min_chance=1):
+    gold, chosen, missing = planner.cover(spells, min_chance)
+    lines = ['{0} - cheapest mages with {1} chance or more:'.format(
+        planner.nation, min_chance)]
+    for mage, sps in chosen:
+        lines.append('  {0}: {1}'.format(mage, ', '.join(sp.name
+                                                          for sp in sps)))
+    lines.append('Total: {0} gold'.format(gold))
+    if missing:
+        lines.append('No mage can cast: {0}'.format(', '.join(
+            sp.name for sp in missing)))
+    return '\n'.join(lines) + '\n'
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Plans rituals, forgings and mages of a nation.')
+    parser.add_argument('nation', help="like 'Ulm'")
+    parser.add_argument('--data', default=core.default_datafile(),
+                        help='gamedata.json or gamedata.bin')
+    parser.add_argument('--turns', type=int,
+                        help='only rituals and forgings paid for within this '
+                        'many turns of gem income')
+    parser.add_argument('--cover', metavar='SPELL', nargs='+',
+                        help='find the cheapest recruitable mages able to '
+                        'cast these spells, given by name or hash')
+    parser.add_argument('--min-chance', type=Frac, default=Frac(1),
+                        help="chance a mage needs to count as a caster, like "
+                        "'1/2'")
+    args = parser.parse_args()
+    data = core.load_gamedata(args.data)
+    try:
+        ndata = core.find_nation(data, args.nation)
+    except KeyError as err:
+        parser.error('No such nation: {0}'.format(err))
+    planner = Planner(data, ndata)
+    if args.cover:
+        try:
+            spells = [planner.find(name) for name in args.cover]
+            spells = list({sp.hash: sp for sp in spells}.values())
+        except KeyError as err:
+            sys.exit('No such spell in {0}: {1}'.format(planner.nation, err))
+        sys.stdout.write(render_cover(planner, spells, args.min_chance))
+    else:
+        sys.stdout.write(render_rituals(planner, args.turns))
+    core.variant_cache.save()
+
+if __name__ == '__main__':
+    main()
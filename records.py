@@ -0,0 +1,188 @@
+#
+# Record types of the game data. Spells, items and mages from gamedata.json
+# (or gamedata.bin) are loaded as these, and mage variants are made of them.
+#
+# Records have __slots__ instead of a __dict__, and fields derived from the
+# data - combined paths, sort key, packed requirement - are computed once,
+# when the record is made. Fields can still be read like the keys of the
+# dicts records replaced: spell['name'] is spell.name.
+#
+MAGIC_PATHS = 'FAWESDNBH' # Sort order, etc
+
+# Path levels are packed into one int, LEVEL_BITS per path in MAGIC_PATHS
+# order. The top bit of every field is a guard, so levels must stay below 128.
+LEVEL_BITS = 8
+LEVEL_GUARD = sum(1 << (LEVEL_BITS * (nr + 1) - 1)
+                  for nr in range(len(MAGIC_PATHS)))
+
+
+def packed_levels(paths):
+    """'FFWE' ---> F2 W1 E1 as a single int (see LEVEL_BITS)"""
+    packed = 0
+    for nr, path in enumerate(MAGIC_PATHS):
+        packed |= paths.count(path) << (LEVEL_BITS * nr)
+    return packed
+
+def requirement(path1, path2):
+    """Packed minimum path levels of a spell. A path present in both path1
+    and path2 needs the higher of the two."""
+    req = 0
+    for nr, path in enumerate(MAGIC_PATHS):
+        req |= max(path1.count(path), path2.count(path)) << (LEVEL_BITS * nr)
+    return req
+
+
+class Record:
+    """Base of the record types. FIELDS are those of gamedata.json."""
+    __slots__ = ()
+    FIELDS = ()
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __contains__(self, key):
+        return hasattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def keys(self):
+        return self.FIELDS
+
+    def as_dict(self):
+        """Fields as in gamedata.json"""
+        return {key: getattr(self, key) for key in self.FIELDS}
+
+    def __eq__(self, other):
+        return (type(self) is type(other) and
+                all(getattr(self, key) == getattr(other, key)
+                    for key in self.FIELDS))
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, key) for key in self.FIELDS))
+
+    def __repr__(self):
+        return '{0}({1})'.format(type(self).__name__, ', '.join(
+            '{0}={1!r}'.format(key, getattr(self, key)) for key in self.FIELDS))
+
+    @classmethod
+    def from_dict(cls, fields):
+        return cls(*[fields[key] for key in cls.FIELDS])
+
+
+class Item(Record):
+    """An item to forge. Spells are items with summoned mages."""
+    FIELDS = ('hash', 'name', 'path1', 'path2', 'level', 'mode', 'gems',
+              'boosts')
+    __slots__ = FIELDS + ('paths', 'sort_key', 'req')
+
+    def __init__(self, hash, name, path1, path2, level, mode, gems, boosts):
+        self.hash = hash
+        self.name = name
+        self.path1 = path1
+        self.path2 = path2
+        self.level = level
+        self.mode = mode
+        self.gems = gems
+        self.boosts = boosts
+        self.paths = path1 + path2
+        self.sort_key = (len(self.paths), self.paths)
+        self.req = requirement(path1, path2)
+
+
+class Spell(Item):
+    FIELDS = Item.FIELDS + ('sumages',)
+    __slots__ = ('sumages',)
+
+    def __init__(self, hash, name, path1, path2, level, mode, gems, boosts,
+                 sumages=()):
+        super().__init__(hash, name, path1, path2, level, mode, gems, boosts)
+        self.sumages = tuple(sumages)
+
+
+class MageData(Record):
+    """A mage as stored in the game data; see core.Mage for its variants"""
+    FIELDS = ('name', 'paths', 'gcost')
+    __slots__ = FIELDS
+
+    def __init__(self, name, paths, gcost):
+        self.name = name
+        self.paths = paths
+        self.gcost = gcost
+
+
+class Variant(Record):
+    """Paths a mage might have, with their chance and a note for the
+    report. levels are the paths packed by packed_levels(). weight is the
+    chance as an int, over the denominator of the mage (see core.Mage);
+    chance is the same as a Fraction, for display."""
+    FIELDS = ('paths', 'chance', 'meta')
+    __slots__ = FIELDS + ('levels', 'weight')
+
+    def __init__(self, paths, chance=None, meta='', levels=None, weight=None):
+        self.paths = paths
+        self.chance = chance
+        self.meta = meta
+        self.levels = packed_levels(paths) if levels is None else levels
+        self.weight = weight
+
+    # Variants are modified, see core.Mage, so they're equal only to
+    # themselves, like their hash
+    __eq__ = object.__eq__
+    __hash__ = object.__hash__
+
+    def copy(self):
+        return Variant(self.paths, self.chance, self.meta, self.levels,
+                       self.weight)
+
+    def __reduce__(self):
+        return Variant, (self.paths, self.chance, self.meta, self.levels,
+                         self.weight)
+
+
+class Interner:
+    """Shares equal records, strings and containers between game data files
+    loaded into one process, so that each file after the first costs about
+    as much as its differences. Shared values must not be modified."""
+    def __init__(self):
+        self.strings = dict()
+        self.records = dict() # record ---> the same, first one made
+        self.containers = dict() # hash of frozen() ---> lists and dicts
+
+    def text(self, word):
+        return self.strings.setdefault(word, word)
+
+    def record(self, cls, fields):
+        """A record of type cls with fields (a dict with cls.FIELDS), the
+        same one for equal fields"""
+        record = cls(*[self.text(fields[key]) if isinstance(fields[key], str)
+                       else fields[key] for key in cls.FIELDS])
+        return self.records.setdefault(record, record)
+
+    def frozen(self, value):
+        """Hashable stand-in for value; shared records stand for themselves"""
+        if isinstance(value, Record):
+            return (Record, id(value))
+        if isinstance(value, list):
+            return (list,) + tuple(self.frozen(item) for item in value)
+        if isinstance(value, dict):
+            return (dict,) + tuple(sorted((key, self.frozen(item))
+                                          for key, item in value.items()))
+        return value
+
+    def container(self, value):
+        """value, or an equal list or dict passed here before"""
+        candidates = self.containers.setdefault(hash(self.frozen(value)), [])
+        for candidate in candidates:
+            if candidate == value:
+                return candidate
+        candidates.append(value)
+        return value
+
+
+def from_fields(cls, fields):
+    """Record of type cls from a dict with cls.FIELDS, not shared"""
+    return cls.from_dict(fields)
@@ -0,0 +1,220 @@
+#! /usr/bin/env python3
+#
+# Baba Yaga query server. Game data and mage variants are loaded once and
+# queries are answered from memory, as JSON over HTTP:
+#
+#   /nations                          names of all nations
+#   /nation?name=Ulm[&format=reST]    spells by mage (json, reST or csv)
+#           [&dominance=chance]
+#   /chance?mage=ID&spell=HASH        chance_to_cast of a spell by a mage;
+#                                     mages and spells can be given by name
+#   /variants?mage=ID                 variants of a mage
+#   /who-casts?spell=HASH             mages of all nations able to cast it
+#   /datasets                         names of the loaded data files
+#
+# Every query but /datasets takes &dataset=NAME, the first one by default.
+#
+# Usage: ./server.py [--port 8000 | --socket /tmp/babayaga.sock]
+#                    [--data [NAME=]FILE ...]
+#   curl 'http://127.0.0.1:8000/nation?name=Ulm'
+#   curl --unix-socket /tmp/babayaga.sock 'http://localhost/variants?mage=41'
+#   ./server.py --data dom3=dom3.json --data dom4=dom4.json
+#
+import os
+import sys
+import json
+import asyncio
+import argparse
+import threading
+import traceback
+from urllib.parse import urlsplit, parse_qs
+
+import core
+
+
+class QueryError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Queries:
+    """Answers to queries, kept warm. Each query returns (content type,
+    text). Nation reports are computed once, under a lock of their nation,
+    since Nations keep caches of their own; other nations aren't held up.
+    Everything else is only read."""
+    def __init__(self, data):
+        self.data = data
+        self.index = core.SpellIndex(data)
+        self.nations = dict() # name ---> Nation
+        self.locks = dict() # str(nation) ---> Lock
+        self.rendered = dict() # (name, dominance, format) ---> text
+        for ndata in data['nations']:
+            nation = core.Nation(ndata, data['mages'])
+            self.nations.setdefault(nation.name, nation)
+            self.nations[str(nation)] = nation
+            self.locks[str(nation)] = threading.Lock()
+        self.mages = dict(self.index.mages) # mage id ---> Mage
+        self.names = dict() # mage name ---> mage id, first one wins
+        for mage_id in sorted(data['mages']):
+            self.names.setdefault(data['mages'][mage_id].name, mage_id)
+
+    def mage(self, query):
+        """Mage by id or by name"""
+        key = query.get('mage', '')
+        mage_id = int(key) if key.isdecimal() else self.names.get(key)
+        if mage_id is None or mage_id not in self.data['mages']:
+            raise QueryError(404, 'No such mage: {0}'.format(key))
+        if mage_id not in self.mages:
+            md = self.data['mages'][mage_id]
+            self.mages[mage_id] = core.Mage(md.paths, md.name, md.gcost)
+        return self.mages[mage_id]
+
+    def spell(self, query):
+        """Spell or item by hash or by name"""
+        found = self.index.find(query.get('spell', ''))
+        if not found:
+            raise QueryError(404, 'No such spell: {0}'.format(
+                query.get('spell', '')))
+        return self.index.spells[found[0]]
+
+    def answer(self, path, query):
+        handler = {'/nations': self.all_nations, '/nation': self.nation,
+                   '/chance': self.chance, '/variants': self.variants,
+                   '/who-casts': self.who_casts}.get(path)
+        if handler is None:
+            raise QueryError(404, 'No such query: {0}'.format(path))
+        return handler(query)
+
+    def all_nations(self, query):
+        names = [str(nation) for nation in self.nations.values()]
+        return json_answer(sorted(set(names)))
+
+    def nation(self, query):
+        name = query.get('name', '')
+        dominance = query.get('dominance', 'paths')
+        fmt = query.get('format', 'json')
+        if name not in self.nations:
+            raise QueryError(404, 'No such nation: {0}'.format(name))
+        if fmt not in core.RENDERERS or dominance not in ('paths', 'chance'):
+            raise QueryError(400, 'Unknown format or dominance')
+        nation = self.nations[name]
+        key = (str(nation), dominance, fmt)
+        if key not in self.rendered:
+            with self.locks[str(nation)]:
+                if key not in self.rendered: # Or made while we waited
+                    spells = (self.data['spells'] + nation.nspells +
+                              self.data['items'])
+                    by_mage = nation.spells_by_mage(spells, dominance)
+                    self.rendered[key] = core.RENDERERS[fmt]().nation(
+                        nation, by_mage)
+        content_type = {'json': 'application/json', 'csv': 'text/csv'}
+        return content_type.get(fmt, 'text/plain'), self.rendered[key]
+
+    def chance(self, query):
+        mage, spell = self.mage(query), self.spell(query)
+        return json_answer({'mage': str(mage), 'spell': spell.name,
+                            'hash': spell.hash,
+                            'chance': str(mage.chance_to_cast(spell))})
+
+    def variants(self, query):
+        mage = self.mage(query)
+        return json_answer({'mage': str(mage), 'variants': [
+            {'paths': var.paths, 'chance': str(var.chance), 'meta': var.meta}
+            for var in mage.variants]})
+
+    def who_casts(self, query):
+        spell = self.spell(query)
+        return json_answer([
+            {'nation': '{0}: {1}'.format(ndata['name'], ndata['epithet']),
+             'mage': str(mage), 'chance': str(chance)}
+            for ndata, mage, chance in self.index.who_can_cast(spell.hash)])
+
+
+def json_answer(value):
+    return 'application/json', json.dumps(value, sort_keys=True)
+
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+def dataset_queries(datasets, url, query):
+    """Queries of the dataset chosen by the query"""
+    if url.path == '/datasets':
+        return lambda path, query: json_answer(list(datasets))
+    name = query.get('dataset', next(iter(datasets)))
+    if name not in datasets:
+        raise QueryError(404, 'No such dataset: {0}'.format(name))
+    return datasets[name].answer
+
+async def handle(datasets, reader, writer):
+    """Serves one HTTP request; the query itself runs in a thread, so slow
+    queries don't hold up other clients"""
+    try:
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass # Headers aren't needed
+            parts = request.decode('latin-1').split()
+            if len(parts) < 2 or parts[0] != 'GET':
+                raise QueryError(405, 'Only GET requests are served')
+            url = urlsplit(parts[1])
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            answer = dataset_queries(datasets, url, query)
+            loop = asyncio.get_running_loop()
+            content_type, body = await loop.run_in_executor(
+                None, answer, url.path, query)
+            status = 200
+        except QueryError as err:
+            status, content_type = err.status, 'application/json'
+            body = json.dumps({'error': str(err)})
+        except Exception:
+            traceback.print_exc() # A bug, but the client still gets an answer
+            status, content_type = 500, 'application/json'
+            body = json.dumps({'error': 'Internal error'})
+        body = body.encode('utf-8')
+        head = ('HTTP/1.1 {0} {1}\r\nContent-Type: {2}; charset=utf-8\r\n'
+                'Content-Length: {3}\r\nConnection: close\r\n\r\n').format(
+                status, REASONS[status], content_type, len(body))
+        writer.write(head.encode('latin-1') + body)
+        await writer.drain()
+    finally:
+        writer.close()
+
+async def serve(datasets, port=8000, socket_path=None):
+    """datasets - {name: Queries}"""
+    client = lambda reader, writer: handle(datasets, reader, writer)
+    if socket_path:
+        server = await asyncio.start_unix_server(client, socket_path)
+    else:
+        server = await asyncio.start_server(client, '127.0.0.1', port)
+    async with server:
+        await server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Answers queries about castable spells from memory.')
+    parser.add_argument('--data', metavar='[NAME=]FILE', action='append',
+                        help='gamedata.json or gamedata.bin, named after the '
+                        'file by default; repeat to load several')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='TCP port on 127.0.0.1')
+    parser.add_argument('--socket', help='serve on this Unix socket instead')
+    args = parser.parse_args()
+    loaded = core.Datasets()
+    datasets = dict()
+    for spec in args.data or [core.default_datafile()]:
+        name, sep, filename = spec.rpartition('=')
+        name = name or os.path.splitext(os.path.basename(filename))[0]
+        datasets[name] = Queries(loaded.load(name, filename))
+        core.variant_cache.save()
+    print('Serving on {0}'.format(args.socket or
+                                  'http://127.0.0.1:{0}'.format(args.port)),
+          file=sys.stderr)
+    try:
+        asyncio.run(serve(datasets, args.port, args.socket))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()